@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 
 import os
+import sys
 import shutil
 from . import debug
 
@@ -28,6 +29,12 @@ DEBUG = debug.DEBUG
 SESSION_COOKIE_AGE = 86400 
 SESSION_SAVE_EVERY_REQUEST = True
 
+# python interpreter running the background management commands (feature
+# extraction jobs, trace repository builds). Under uWSGI sys.executable is
+# the uwsgi binary, hence the interpreter of the environment is used
+BACKGROUND_PYTHON = os.environ.get('BSPG_BACKGROUND_PYTHON', \
+        os.path.join(sys.prefix, 'bin', 'python'))
+
 PROXIES = {}
 
 if DEV:
@@ -0,0 +1,29 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from efelg.tools import feature_store
+
+
+class Command(BaseCommand):
+    help = 'Precompute the eFEL features of all the traces of the ' + \
+            'efelg repository'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json-dir', \
+                default=os.path.join(settings.MEDIA_ROOT, 'efel_data', \
+                'eg_json_data', 'traces'))
+        parser.add_argument('--store-path', default=feature_store.STORE_PATH)
+        parser.add_argument('--conf', default=feature_store.CONF_PATH, \
+                help='feature configuration file (FEATUREEXCLUDE)')
+        parser.add_argument('--processes', type=int, default=None, \
+                help='number of worker processes (default: number of CPUs)')
+
+    def handle(self, *args, **options):
+        errors = feature_store.build_cube(options['json_dir'], \
+                path=options['store_path'], conf_path=options['conf'], \
+                processes=options['processes'])
+
+        for json_path, message in errors:
+            self.stderr.write("%s: %s" % (json_path, message))
+        self.stdout.write("Feature cube built (%d errors)" % len(errors))
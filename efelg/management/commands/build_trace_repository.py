@@ -0,0 +1,42 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from efelg.tools import repository
+
+
+class Command(BaseCommand):
+    help = 'Convert new or modified .abf files of the efelg raw data folder'
+
+    def add_arguments(self, parser):
+        app_data_dir = os.path.join(settings.MEDIA_ROOT, 'efel_data', \
+                'app_data')
+        main_json_dir = os.path.join(settings.MEDIA_ROOT, 'efel_data', \
+                'eg_json_data')
+        parser.add_argument('--data-dir', \
+                default=os.path.join(app_data_dir, 'efelg_rawdata'))
+        parser.add_argument('--json-dir', \
+                default=os.path.join(main_json_dir, 'traces'))
+        parser.add_argument('--store-dir', \
+                default=os.path.join(main_json_dir, 'trace_store'))
+        parser.add_argument('--app-data-dir', default=app_data_dir)
+        parser.add_argument('--index-path', \
+                default=os.path.join(main_json_dir, 'trace_index.sqlite'))
+        parser.add_argument('--processes', type=int, default=None, \
+                help='number of worker processes (default: number of CPUs)')
+        parser.add_argument('--force', action='store_true', \
+                help='convert all the files, ignoring the manifest')
+
+    def handle(self, *args, **options):
+        try:
+            errors = repository.build_repository(options['data_dir'], \
+                    options['json_dir'], options['store_dir'], \
+                    options['app_data_dir'], \
+                    index_path=options['index_path'], \
+                    processes=options['processes'], force=options['force'])
+        except repository.RepositoryLocked as e:
+            raise CommandError(str(e))
+
+        for abf_path, message in errors:
+            self.stderr.write("%s: %s" % (abf_path, message))
+        self.stdout.write("Trace repository built (%d errors)" % len(errors))
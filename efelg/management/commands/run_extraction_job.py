@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from efelg.tools import extraction
+
+
+class Command(BaseCommand):
+    help = 'Run the feature extraction job described in JOB_DIR/job.json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_dir')
+        parser.add_argument('--plots-only', action='store_true', \
+                help='only generate the figures of a job already run')
+
+    def handle(self, *args, **options):
+        if not extraction.run(options['job_dir'], \
+                plots_only=options['plots_only']):
+            raise CommandError("Feature extraction failed")
@@ -2,14 +2,75 @@ $(document).ready(function(){
     window.scrollTo(0,0);
     openMessageDiv("load-message", "main-e-res-div");
     //
-    $.getJSON('/efelg/extract-features', function(data){
-        if (data["status"] == "OK"){
+    // jobs not started are reported as failed by the status endpoint. The
+    // figures are generated once the features are extracted (see
+    // generatePlots)
+    $.getJSON('/efelg/extract-features?plots=0', function(data){
+        pollExtractionStatus();
+    });
+});
+
+// starts the generation of the figures of the completed extraction job and
+// polls its status, unless the figures are already available
+var plotsRequested = false;
+function generatePlots() {
+    plotsRequested = true;
+    $.post('/efelg/generate_plots', {
+        csrfmiddlewaretoken: $('input[name=csrfmiddlewaretoken]').val(),
+    }, function(data){
+        if (data["ready"]) {
+            hideDiv("features-ready-div");
+            showDiv("exec-completed-div");
+        } else if (data["status"] == "KO") {
+            hideDiv("features-ready-div");
+            document.getElementById("exec-failed-message").innerHTML = 
+                data["message"];
+            showDiv("exec-failed-div");
+        } else {
+            showDiv("features-ready-div");
+            setTimeout(pollExtractionStatus, 2000);
+        }
+    }, 'json');
+}
+
+// polls the status of the extraction job until it is completed or failed.
+// The feature files are made available as soon as they are ready, while the
+// figures are still being generated
+var featuresReady = false;
+function pollExtractionStatus() {
+    $.getJSON('/efelg/extraction_status', function(data){
+        if (data["features_ready"] && !featuresReady) {
+            featuresReady = true;
             $.getJSON('/efelg/features-json-files-path', function(data_path){
                 document.getElementById("hiddendiv").className = 
                     data_path['path'];
-                showDiv("exec-completed-div");
             });
             closeMessageDiv("load-message", "main-e-res-div");
-        };
+        }
+        if (data["status"] == "OK" && !plotsRequested) {
+            closeMessageDiv("load-message", "main-e-res-div");
+            generatePlots();
+        } else if (data["status"] == "OK") {
+            hideDiv("features-ready-div");
+            showDiv("exec-completed-div");
+            closeMessageDiv("load-message", "main-e-res-div");
+        } else if (data["status"] == "KO") {
+            hideDiv("features-ready-div");
+            document.getElementById("exec-failed-message").innerHTML = 
+                data["message"];
+            showDiv("exec-failed-div");
+            closeMessageDiv("load-message", "main-e-res-div");
+        } else {
+            if (featuresReady) {
+                showDiv("features-ready-div");
+            } else if (data["status"] == "QUEUED") {
+                $("#extraction-stage").html("Waiting for a free worker");
+            } else {
+                $("#extraction-stage").html("Running step " + 
+                        (data["progress"] + 1) + " of " + 
+                        data["stages"].length + ": " + data["stage"]);
+            }
+            setTimeout(pollExtractionStatus, 2000);
+        }
     });
-});
+}
@@ -120,6 +120,89 @@ function closeUserChoiceList() {
     }
 }
 
+// Fetches the traces of a cell in binary format (see
+// efelg/tools/trace_transport.py) and passes them to callback, every trace
+// being a Float32Array
+function getTraceData(cellname, callback) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', '/efelg/get_data/' + cellname + '?format=bin');
+    xhr.responseType = 'arraybuffer';
+    xhr.setRequestHeader('Accept', 'application/octet-stream');
+    xhr.onload = function() {
+        if (xhr.status != 200)
+            return;
+        callback(decodeTraceData(xhr.response));
+    };
+    xhr.send();
+}
+
+// Decodes a binary payload of traces, returning the cell object
+function decodeTraceData(buffer) {
+    var header_len = new DataView(buffer).getUint32(0, true);
+    var header_bytes = new Uint8Array(buffer, 4, header_len);
+    var cell_obj = JSON.parse(new TextDecoder('utf-8').decode(header_bytes));
+    var data_start = 4 + header_len;
+    var traces = {};
+    for (var i = 0; i < cell_obj['traces'].length; i++) {
+        var label = cell_obj['traces'][i][0];
+        var offset = cell_obj['traces'][i][1];
+        var length = cell_obj['traces'][i][2];
+        traces[label] = new Float32Array(buffer, data_start + 4 * offset, length);
+    }
+    cell_obj['traces'] = traces;
+    return cell_obj;
+}
+
+// Fetches the traces of many cells with a single request and passes every
+// cell to callback as soon as it is received. The response is a sequence
+// of binary payloads, each one preceded by its length
+function getTraceDataBatch(cellnames, callback) {
+    // the list of cells may not fit in a url, post it with the csrf token
+    // of the upload form
+    var params = $.param({
+        cell: cellnames,
+        csrfmiddlewaretoken: $('input[name=csrfmiddlewaretoken]').val(),
+    }, true);
+    return fetch('/efelg/get_data_batch', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {
+            'Accept': 'application/octet-stream',
+            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+        },
+        body: params,
+    }).then(function(response) {
+        if (!response.ok)
+            throw new Error('get_data_batch failed: ' + response.status);
+        var reader = response.body.getReader();
+        var pending = new Uint8Array(0);
+
+        function read() {
+            return reader.read().then(function(result) {
+                if (result.done)
+                    return;
+                var chunk = new Uint8Array(pending.length + result.value.length);
+                chunk.set(pending);
+                chunk.set(result.value, pending.length);
+
+                // decode all the complete records received so far
+                var pos = 0;
+                while (chunk.length - pos >= 4) {
+                    var len = new DataView(chunk.buffer, pos, 4).getUint32(0, true);
+                    if (chunk.length - pos - 4 < len)
+                        break;
+                    var cell_obj = decodeTraceData(chunk.slice(pos + 4, pos + 4 + len).buffer);
+                    callback(cell_obj['cellname'], cell_obj);
+                    pos += 4 + len;
+                }
+                pending = chunk.slice(pos);
+                return read();
+            });
+        }
+        return read();
+    });
+}
+
 // Plotting class
 function TracePlot(container_id, cell_obj) {
     const SHOW_FADED = 0.15;
@@ -254,6 +337,17 @@ function TracePlot(container_id, cell_obj) {
             }                     
         })
 
+        // Keeps the full view data for restoring them after zooming
+        self.labels = plotdata.map(function(t) {
+            return t.name.split(' ')[0];
+        });
+        self.full_x = plotdata.map(function(t) {
+            return t.x;
+        });
+        self.full_y = plotdata.map(function(t) {
+            return t.y;
+        });
+
         var layout = {
             legend: {
                 orientation: "h",
@@ -274,8 +368,36 @@ function TracePlot(container_id, cell_obj) {
         self.refresh();
     }
 
+    // Reloads the traces in the [t_start, t_end] window at the resolution
+    // matching the plot width
+    function loadWindow(t_start, t_end) {
+        var params = $.param({
+            stim: self.labels,
+            t_start: t_start,
+            t_end: t_end,
+            points: 2 * self.plotbox.width(),
+        }, true);
+        $.getJSON('/efelg/get_data_window/' + container_id + '?' + params, function(data) {
+            var x = [];
+            var y = [];
+            for (var i = 0; i < self.labels.length; i++) {
+                var trace = data['traces'][self.labels[i]];
+                y.push(trace);
+                x.push(trace.map((v, j) => data['t_start'] + j * 1000 / data['disp_sampling_rate']));
+            }
+            Plotly.restyle(self.plotbox.attr('id'), {x: x, y: y});
+        })
+    }
+
     function bindEvents() {
-        self.plotbox.on('plotly_relayout', function(ev) {
+        self.plotbox.on('plotly_relayout', function(ev, data) {
+            if (data && 'xaxis.range[0]' in data) {
+                loadWindow(data['xaxis.range[0]'], data['xaxis.range[1]']);
+            } else if (data && 'xaxis.range' in data) {
+                loadWindow(data['xaxis.range'][0], data['xaxis.range'][1]);
+            } else if (data && 'xaxis.autorange' in data) {
+                Plotly.restyle(self.plotbox.attr('id'), {x: self.full_x, y: self.full_y});
+            }
             self.refresh();
         })
 
@@ -405,8 +527,8 @@ $(document).ready(function(){
                     var counter = 0;
                 $.each(all_json_names, function(idx, elem) {
                     $('#' + index).append('<div id="' + elem + '"></div>');
-                    $.getJSON('/efelg/get_data/' + elem, function(data) {
-                        new TracePlot(elem, JSON.parse(data));
+                    getTraceData(elem, function(data) {
+                        new TracePlot(elem, data);
                         counter = counter + 1;
                         if (counter == all_json_names.length){
                             closeMessageDiv("wait-message-div", "main-e-st-div");
@@ -553,6 +675,7 @@ function applySelection() {
     openMessageDiv("wait-message-div", "main-e-st-div");
     $('#charts').empty();
     cells = Object.keys(json['Contributors'][contributor][specie][structure][region][type][etype]);
+    var fileNames = [];
     for (var i = 0; i < cells.length; i++) {
         var cell = cells[i];
         // adding cell container per fileId
@@ -589,15 +712,21 @@ function applySelection() {
         file.forEach(function (el) {
             var fileName = el.split('.')[0];
             $('#' + cell).append('<div id="' + fileName + '"></div>');
-            $.getJSON('/efelg/get_data/' + fileName, function(data) {
-                writeMessage("wmd-first", "Cell " + (i + 1).toString() +
-                        + " of " + (cells.length + 1).toString() +
-                        + ". Loading traces for file " + (1 + 1).toString() +
-                        + " of " + (file.length + 1).toString());
-                new TracePlot(fileName, JSON.parse(data));
-            })
+            fileNames.push(fileName);
         });
     }
+
+    // load the traces of all the cells with a single request
+    var loaded = 0;
+    getTraceDataBatch(fileNames, function(fileName, data) {
+        loaded = loaded + 1;
+        writeMessage("wmd-first", "Loading traces for file " + loaded.toString() +
+                " of " + fileNames.length.toString());
+        if (!data['error'])
+            new TracePlot(fileName, data);
+    }).catch(function(error) {
+        console.error(error);
+    });
     closeMessageDiv("wait-message-div", "main-e-st-div");
     writeMessage("wmd-first", "");
     writeMessage("wmd-second", "");
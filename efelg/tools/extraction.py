@@ -0,0 +1,641 @@
+'''
+Feature extraction jobs.
+
+extract_features (see views) only builds the bluepyefe configuration and
+writes it, together with the paths of the outputs, into a job.json file in
+the user result folder. The job is then run in a separate process by the
+run_extraction_job management command. At most WORKERS jobs run at the same
+time on a host: every job waits for one of the WORKERS slot lock files
+before running. The progress of the job is kept in the job_status.json file
+of the same folder and read by the extraction_status endpoint.
+
+The results of every job are kept in a content addressed cache, keyed by
+the hash of the selected traces md5, the selected stimuli and features and
+the extraction options (see cache_key). When the same extraction is
+requested again, extract_features hard links the cached results into the
+user folder instead of starting a job (see load_cached). The cache is bounded: when its size exceeds CACHE_MAX_SIZE
+bytes the least recently used results, i.e. the ones with the oldest
+modification time of their folder, are removed.
+
+When more than one cell is selected, the dataset creation and the feature
+extraction (i.e. the per cell steps of bluepyefe) run for every cell in a
+separate process (see extract_cells), and their results are merged before
+the per cell results are averaged. Both pools of a job are sized so that
+the WORKERS concurrent jobs do not use more processes than the host cores. Otherwise the eFEL features of all the
+traces are computed in a pool of processes, as many as the efel_workers
+extraction option, before running the feature extraction (see
+prefetch_features).
+
+The figures are generated after the feature files (features.json and
+protocols.json), which are usable as soon as the job status reports
+features_ready. If the job is submitted with plots set to false, the
+figures are generated only when requested (see the generate_plots view), by
+a further run of the job with plots_only set (see submit_plots).
+
+No zip archive is written by the job: the results are zipped on the fly
+when downloaded (see zip_stream).
+'''
+
+import os
+import json
+import time
+import errno
+import fcntl
+import copy
+import shutil
+import hashlib
+import tempfile
+import logging
+import multiprocessing
+import matplotlib
+matplotlib.use('Agg')
+import bluepyefe as bpefe
+from django.conf import settings
+from . import resources
+from . import feature_store
+
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'job.json'
+STATUS_NAME = 'job_status.json'
+
+# pid of the process running the job, written when the job is started
+PID_NAME = 'job.pid'
+
+# seconds a job without pid file is considered as being started
+START_GRACE = 60
+
+# marker of the figures generation of a job, created by the request that
+# starts it (see submit_plots)
+PLOTS_NAME = 'plots.claimed'
+SLOTS_DIR = os.path.join(settings.MEDIA_ROOT, 'efel_data', 'efel_gui', \
+        'extraction_slots')
+WORKERS = max(1, multiprocessing.cpu_count() // 2)
+# size of the process pools of a job: the WORKERS jobs running at the same
+# time share the cores of the host
+CELL_WORKERS = max(1, multiprocessing.cpu_count() // WORKERS)
+EFEL_WORKERS = max(1, multiprocessing.cpu_count() // WORKERS)
+# extraction options which do not change the results, left out of the
+# cache key
+RUNTIME_OPTIONS = ('efel_workers',)
+CACHE_DIR = os.path.join(settings.MEDIA_ROOT, 'efel_data', 'efel_gui', \
+        'extraction_cache')
+# size of the cached results beyond which the least recently used ones are
+# evicted, down to CACHE_EVICT_TARGET * CACHE_MAX_SIZE
+CACHE_MAX_SIZE = 10 << 30
+CACHE_EVICT_TARGET = 0.9
+
+# stage reported for jobs served from the cache
+CACHED = 'cached'
+
+# pipeline stages, in execution order
+STAGES = ['create_dataset', 'extract_features', 'mean_features', \
+        'feature_config_cells', 'feature_config_all', 'citations', \
+        'plt_traces', 'plt_features']
+
+# stages generating the figures
+PLOT_STAGES = ['plt_traces', 'plt_features']
+
+# stages needed by the figures only
+DATA_STAGES = ['create_dataset', 'extract_features', 'mean_features']
+
+# last stage before the feature files are complete
+FEATURES_STAGE = 'citations'
+
+# job status values
+QUEUED = 'QUEUED'
+RUNNING = 'RUNNING'
+OK = 'OK'
+KO = 'KO'
+
+
+# return the bluepyefe options of the extractions run by the application
+def default_options(target, efel_workers=EFEL_WORKERS):
+    return {
+            'featconffile': './pt_conf.json',
+            'featzerotonan': False,
+            'relative': False, 
+            'tolerance': 0.02,
+            'target': target, 
+            'target_unit': 'nA',
+            'delay': 500, 
+            'nanmean': True, 
+            'logging':True, 
+            'nangrace': 0, 
+            'spike_threshold': 1, 
+            'amp_min': -1e22, 
+            'zero_std': False,
+            'trace_check': False,
+            'strict_stiminterval': {
+                'base': True
+                },
+            'print_table': {
+                    'flag': True,
+                    'num_events': 5,
+                    },
+            # not a bluepyefe option: processes computing the eFEL features
+            # (see prefetch_features)
+            'efel_workers': efel_workers,
+            }
+
+
+def cache_key(config, md5s, selected_traces):
+    '''
+    Return the key of the results of an extraction: md5s maps every
+    selected file to the md5 of its trace data, selected_traces every file
+    to the selected stimuli
+    '''
+
+    content = {
+        'md5': md5s,
+        'stim': dict((k, sorted(v['stim'])) for k, v in \
+                selected_traces.items()),
+        'features': config['features'],
+        'cells': config['cells'],
+        'options': dict((k, v) for k, v in config['options'].items() \
+                if k not in RUNTIME_OPTIONS),
+    }
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()) \
+            .hexdigest()
+
+
+# hard link src to dst, falling back (e.g. on a different file system) to a
+# symbolic link if symlink is set, and then to a copy
+def link_file(src, dst, symlink=False):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    if symlink:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    for root, folders, files in os.walk(src):
+        crr_dst = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.exists(crr_dst):
+            os.makedirs(crr_dst)
+        for name in files:
+            link_file(os.path.join(root, name), os.path.join(crr_dst, name))
+
+
+# link the cached results of key into the job folders, if available
+def load_from_cache(key, job):
+    if not key or not os.path.isdir(os.path.join(CACHE_DIR, key)):
+        return False
+    crr_cache_dir = os.path.join(CACHE_DIR, key)
+    # record the use of the results for the eviction
+    os.utime(crr_cache_dir, None)
+    if os.path.exists(job['result_dir']):
+        shutil.rmtree(job['result_dir'])
+    link_tree(os.path.join(crr_cache_dir, 'u_res'), job['result_dir'])
+    return True
+
+
+# store the results of a job in the cache
+def store_in_cache(key, job):
+    crr_cache_dir = os.path.join(CACHE_DIR, key)
+    if not key or os.path.isdir(crr_cache_dir):
+        return
+    tmp_cache_dir = crr_cache_dir + '.%d.tmp' % os.getpid()
+    link_tree(job['result_dir'], os.path.join(tmp_cache_dir, 'u_res'))
+    try:
+        os.rename(tmp_cache_dir, crr_cache_dir)
+    except OSError:
+        # another job stored the same results in the meanwhile
+        shutil.rmtree(tmp_cache_dir)
+        return
+    evict_cache()
+
+
+def tree_size(folder):
+    size = 0
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+# if the size of the cache exceeds max_size, remove the least recently used
+# results until it is below CACHE_EVICT_TARGET * max_size
+def evict_cache(max_size=CACHE_MAX_SIZE):
+    entries = []
+    for key in os.listdir(CACHE_DIR):
+        crr_cache_dir = os.path.join(CACHE_DIR, key)
+        # skip the results being stored
+        if key.endswith('.tmp') or not os.path.isdir(crr_cache_dir):
+            continue
+        try:
+            entries.append((os.path.getmtime(crr_cache_dir), \
+                    tree_size(crr_cache_dir), crr_cache_dir))
+        except OSError:
+            # removed by another job in the meanwhile
+            continue
+    size = sum(i[1] for i in entries)
+    if size <= max_size:
+        return
+    for mtime, crr_size, crr_cache_dir in sorted(entries):
+        if size <= max_size * CACHE_EVICT_TARGET:
+            break
+        shutil.rmtree(crr_cache_dir, ignore_errors=True)
+        size -= crr_size
+
+
+def write_status(job_dir, status, stage='', message='', \
+        features_ready=False):
+    status_path = os.path.join(job_dir, STATUS_NAME)
+    tmp_status_path = status_path + '.tmp'
+    crr_status = {'status': status, 'stage': stage, 'message': message, \
+            'stages': STAGES, 'time': time.time(), \
+            'features_ready': features_ready}
+    if stage in STAGES:
+        crr_status['progress'] = STAGES.index(stage)
+    with open(tmp_status_path, 'w') as f:
+        json.dump(crr_status, f)
+    os.rename(tmp_status_path, status_path)
+
+
+def read_status(job_dir):
+    status_path = os.path.join(job_dir, STATUS_NAME)
+    if not os.path.isfile(status_path):
+        return None
+    with open(status_path) as f:
+        return json.load(f)
+
+
+# write the description of a new job into job_dir
+def write_job(job_dir, job):
+    with open(os.path.join(job_dir, JOB_NAME), 'w') as f:
+        json.dump(job, f)
+    # the figures of the new job have not been generated yet
+    if os.path.isfile(os.path.join(job_dir, PLOTS_NAME)):
+        os.remove(os.path.join(job_dir, PLOTS_NAME))
+
+
+def load_cached(job_dir, job):
+    '''
+    Complete the job with the cached results, if available, without
+    starting any process. Return whether the results were found
+    '''
+
+    try:
+        if not load_from_cache(job.get('cache_key'), job):
+            return False
+    except (IOError, OSError):
+        logger.exception("cache not available for job %s", job_dir)
+        return False
+    write_job(job_dir, job)
+    if os.path.isfile(os.path.join(job_dir, PID_NAME)):
+        os.remove(os.path.join(job_dir, PID_NAME))
+    write_status(job_dir, OK, CACHED, features_ready=True)
+    return True
+
+
+def submit(job_dir, job=None, plots_only=False):
+    '''
+    Write the job description and start its execution in background. If
+    plots_only is set, generate the figures of the job already run in
+    job_dir
+    '''
+
+    if job is not None:
+        write_job(job_dir, job)
+    if os.path.isfile(os.path.join(job_dir, PID_NAME)):
+        os.remove(os.path.join(job_dir, PID_NAME))
+    write_status(job_dir, QUEUED, features_ready=plots_only)
+
+    try:
+        process = resources.start_management_command( \
+                ['run_extraction_job', job_dir] + \
+                (['--plots-only'] if plots_only else []), \
+                os.path.join(job_dir, 'job.log'))
+    except OSError:
+        logger.exception("extraction job %s not started", job_dir)
+        write_status(job_dir, KO, message="The extraction job could " + \
+                "not be started.", features_ready=plots_only)
+        return False
+
+    tmp_pid_path = os.path.join(job_dir, PID_NAME + '.tmp')
+    with open(tmp_pid_path, 'w') as f:
+        f.write(str(process.pid))
+    os.rename(tmp_pid_path, os.path.join(job_dir, PID_NAME))
+    return True
+
+
+# check whether the process running the job of job_dir is alive, i.e. it
+# exists, is not a zombie and is still running the job (pids are reused)
+def job_alive(job_dir):
+    pid_path = os.path.join(job_dir, PID_NAME)
+    if not os.path.isfile(pid_path):
+        job_status = read_status(job_dir)
+        return bool(job_status) and \
+                time.time() - job_status['time'] < START_GRACE
+    with open(pid_path) as f:
+        pid = int(f.read())
+
+    proc_dir = os.path.join('/proc', str(pid))
+    if not os.path.isdir('/proc'):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+    try:
+        with open(os.path.join(proc_dir, 'stat')) as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+        with open(os.path.join(proc_dir, 'cmdline')) as f:
+            cmdline = f.read().split('\0')
+    except (IOError, OSError):
+        return False
+    return state != 'Z' and job_dir in cmdline
+
+
+# return the status of the job of job_dir, marking the job as failed if its
+# process died without completing it (e.g. killed by the OOM killer)
+def check_status(job_dir):
+    job_status = read_status(job_dir)
+    if not job_status or job_status['status'] not in [QUEUED, RUNNING] or \
+            job_alive(job_dir):
+        return job_status
+
+    # the job may have completed in the meanwhile
+    job_status = read_status(job_dir)
+    if job_status['status'] in [QUEUED, RUNNING]:
+        logger.error("extraction job %s died", job_dir)
+        write_status(job_dir, KO, job_status.get('stage', ''), \
+                "The extraction job stopped unexpectedly.", \
+                job_status.get('features_ready', False))
+        job_status = read_status(job_dir)
+    return job_status
+
+
+# start the generation of the figures of a job completed without them. The
+# generation is started once per job: the request starting it claims the
+# job by creating the PLOTS_NAME marker, so that concurrent requests do not
+# start it again and a failed generation is reported instead of retried.
+# Return the current status of the job
+def submit_plots(job_dir):
+    job_status = read_status(job_dir)
+    if not job_status or not job_status.get('features_ready') or \
+            job_status['status'] != OK:
+        return job_status
+    try:
+        fd = os.open(os.path.join(job_dir, PLOTS_NAME), \
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return job_status
+    os.close(fd)
+    submit(job_dir, plots_only=True)
+    return read_status(job_dir)
+
+
+# wait until one of the WORKERS slots is free and lock it
+def acquire_slot():
+    if not os.path.exists(SLOTS_DIR):
+        try:
+            os.makedirs(SLOTS_DIR)
+        except OSError:
+            pass
+
+    while True:
+        for i in range(WORKERS):
+            slot_file = open(os.path.join(SLOTS_DIR, 'slot_%d.lock' % i), 'w')
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_file
+            except IOError:
+                slot_file.close()
+        time.sleep(1)
+
+
+def release_slot(slot_file):
+    fcntl.flock(slot_file, fcntl.LOCK_UN)
+    slot_file.close()
+
+
+# run the per cell steps of the extraction for a single cell, in a worker
+# process. Return the cell dataset, the experiments and the feature table
+def extract_cell(args):
+    work_dir, config = args
+    cellname = list(config['cells'].keys())[0]
+    extractor = bpefe.Extractor(work_dir, config, use_git=False)
+    extractor.create_dataset()
+    extractor.extract_features()
+
+    table = ''
+    table_path = os.path.join(work_dir, 'all_feature_table.txt')
+    if os.path.isfile(table_path):
+        with open(table_path) as f:
+            table = f.read()
+
+    return (cellname, extractor.dataset[cellname], extractor.experiments, \
+            table)
+
+
+def extract_cells(extractor, config, processes, result_dir):
+    '''
+    Fill the dataset of extractor (writing to result_dir) running
+    create_dataset and extract_features for every cell of config in a pool
+    of processes
+    '''
+
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(result_dir))
+    args = []
+    for cellname in config['cells']:
+        cell_config = copy.deepcopy(config)
+        cell_config['cells'] = {cellname: config['cells'][cellname]}
+        args.append((os.path.join(work_dir, cellname), cell_config))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(extract_cell, args)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # merge the results, keeping the order of the cells in config
+    tables = []
+    for cellname, dataset, experiments, table in results:
+        extractor.dataset[cellname] = dataset
+        for expname in experiments:
+            if expname not in extractor.experiments:
+                extractor.experiments.append(expname)
+        if table:
+            # keep the header of the first table only
+            tables.append(table if not tables else table.split('\n', 1)[-1])
+    if tables:
+        with open(os.path.join(result_dir, 'all_feature_table.txt'), \
+                'w') as f:
+            f.write(''.join(tables))
+
+
+def prefetch_features(extractor, memo, processes, threshold=-20):
+    '''
+    Compute, in a pool of processes, the eFEL features of all the traces
+    that extractor.extract_features(threshold) is going to analyze and
+    record them in the feature memo, from which extract_features reads them
+    '''
+
+    items = []
+    for cellname in extractor.dataset:
+        dataset_cell_exp = extractor.dataset[cellname]['experiments']
+        for expname in dataset_cell_exp:
+            # same settings as extract_features
+            strict_stiminterval = extractor.options['strict_stiminterval'] \
+                    .get(expname, extractor.options['strict_stiminterval'] \
+                    ['base'])
+            cell_exp = extractor.cells[cellname]['experiments'][expname]
+            if 'threshold' in cell_exp:
+                threshold = cell_exp['threshold']
+            features = [i for i in extractor.features[expname] + \
+                    ['peak_time'] if i not in extractor.extra_features]
+
+            crr_exp = dataset_cell_exp[expname]
+            for i_seg in range(len(crr_exp['voltage'])):
+                trace = {'T': crr_exp['t'][i_seg], \
+                        'V': crr_exp['voltage'][i_seg], \
+                        'stim_start': [crr_exp['ton'][i_seg]], \
+                        'stim_end': [crr_exp['toff'][i_seg]]}
+                calls = [('setThreshold', (threshold,)), \
+                        ('setIntSetting', ('strict_stiminterval', \
+                        strict_stiminterval)), \
+                        ('setDoubleSetting', ('stimulus_current', \
+                        crr_exp['amp'][i_seg]))]
+                items.append((trace, features, calls))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        computed = memo.prefetch(items, pool.map)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    logger.info("%d of %d traces analyzed in %d processes", computed, \
+            len(items), processes)
+
+
+def run(job_dir, plots_only=False):
+    '''
+    Run the job described in job_dir/job.json. If plots_only is set, only
+    generate the figures of a job already run
+    '''
+
+    with open(os.path.join(job_dir, JOB_NAME)) as f:
+        job = json.load(f)
+
+    if plots_only:
+        stages = DATA_STAGES + PLOT_STAGES
+    elif job.get('plots', True):
+        stages = STAGES
+    else:
+        stages = [i for i in STAGES if i not in PLOT_STAGES]
+
+    try:
+        if not plots_only and load_from_cache(job.get('cache_key'), job):
+            write_status(job_dir, OK, CACHED, features_ready=True)
+            return True
+    except (IOError, OSError):
+        logger.exception("cache not available for job %s", job_dir)
+
+    slot_file = acquire_slot()
+    features_ready = plots_only
+    try:
+        stage = stages[0]
+
+        # use the feature values stored at ingest time (if any) and by
+        # previous jobs, recording the new ones
+        feature_stores = []
+        if job.get('feature_store') and \
+                os.path.isfile(job['feature_store']):
+            feature_stores.append(feature_store.open_store( \
+                    job['feature_store']))
+        memo_store = None
+        if job.get('feature_memo'):
+            memo_store = feature_store.open_store(job['feature_memo'], \
+                    max_size=feature_store.MEMO_MAX_SIZE)
+            feature_stores.append(memo_store)
+        memo = None
+        if feature_stores:
+            memo = feature_store.install(feature_stores, \
+                    record_store=memo_store)
+
+        # results of previous runs may be hard linked to the cache, remove
+        # them instead of overwriting them
+        if os.path.exists(job['result_dir']) and not plots_only:
+            shutil.rmtree(job['result_dir'])
+        if plots_only:
+            # keep the feature table of the first run
+            job['config']['options']['print_table']['flag'] = False
+
+        write_status(job_dir, RUNNING, stage, features_ready=features_ready)
+        # the Extractor modifies the configuration, keep the original one
+        # for the per cell extractors
+        config = copy.deepcopy(job['config'])
+        processes = min(len(config['cells']), job.get('cell_workers', 1))
+        extractor = bpefe.Extractor(job['result_dir'], job['config'], \
+                use_git=False)
+        for stage in stages:
+            write_status(job_dir, RUNNING, stage, \
+                    features_ready=features_ready)
+            if processes > 1 and stage == 'create_dataset':
+                extract_cells(extractor, config, processes, \
+                        job['result_dir'])
+            elif processes > 1 and stage == 'extract_features':
+                # already run by extract_cells
+                continue
+            elif stage == 'extract_features':
+                # compute the features of all the traces at once, if they
+                # can be passed to extract_features through the memo
+                efel_workers = config['options'].get('efel_workers', 1)
+                if memo_store and efel_workers > 1:
+                    prefetch_features(extractor, memo, efel_workers)
+                extractor.extract_features()
+            elif stage == 'feature_config_cells':
+                extractor.feature_config_cells(version="legacy")
+            elif stage == 'feature_config_all':
+                extractor.feature_config_all(version="legacy")
+            elif stage == 'citations':
+                resources.print_citations(job['selected_traces'], \
+                        job['citation_conf'], job['citation_file'])
+            else:
+                getattr(extractor, stage)()
+            if stage == FEATURES_STAGE:
+                features_ready = True
+    except Exception:
+        logger.exception("extraction job %s failed", job_dir)
+        if stage == 'citations':
+            message = "An error occured while packaging the results."
+        elif stage in PLOT_STAGES:
+            message = "An error occured while generating the figures."
+        else:
+            message = "An error occured while extracting the features. " + \
+                    "Either you selected too many data or the traces " + \
+                    "were corrupted."
+        write_status(job_dir, KO, stage, message, features_ready)
+        return False
+    finally:
+        release_slot(slot_file)
+
+    # only complete results are cached, i.e. the ones of jobs run with
+    # plots or of the figures generation of a job run without
+    if plots_only or stages == STAGES:
+        try:
+            store_in_cache(job.get('cache_key'), job)
+        except (IOError, OSError):
+            logger.exception("results of job %s not cached", job_dir)
+
+    write_status(job_dir, OK, stage, features_ready=True)
+    return True
@@ -0,0 +1,69 @@
+'''
+Process-level cache of the feature catalog (the feature names grouped by
+feature type, read from efel_features_final.json) and of the eFEL feature
+names.
+
+The catalog is parsed once per worker process and reloaded only when the
+modification time or the size of its file change. The json response sent
+to the browser is serialized once, at load time. The cached objects are
+shared by all the requests and must not be modified.
+'''
+
+import os
+import json
+import threading
+import efel
+from django.conf import settings
+
+CATALOG_PATH = os.path.join(settings.BASE_DIR, 'static', 'efelg', \
+        'efel_features_final.json')
+
+_lock = threading.Lock()
+_catalog = {'stat': None, 'data': None, 'json': None}
+_feature_names = []
+
+
+def _file_stat(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_mtime, stat.st_size)
+
+
+# (re)load the catalog if its file changed since the last load
+def _load():
+    stat = _file_stat(CATALOG_PATH)
+    if stat == _catalog['stat']:
+        return _catalog
+
+    with _lock:
+        if stat != _catalog['stat']:
+            with open(CATALOG_PATH) as json_file:
+                data = json.load(json_file)
+            _catalog.update({'data': data, 'json': json.dumps(data), \
+                    'stat': stat})
+    return _catalog
+
+
+# return the feature names grouped by feature type
+def catalog():
+    return _load()['data']
+
+
+# return the catalog serialized as json
+def catalog_json():
+    return _load()['json']
+
+
+# return the etag of the catalog, based on the modification time and size
+# of its file
+def etag():
+    mtime, size = _load()['stat']
+    return '%x-%x' % (int(mtime * 1e6), size)
+
+
+# return the names of all the features available in eFEL, as a tuple
+def feature_names():
+    if not _feature_names:
+        with _lock:
+            if not _feature_names:
+                _feature_names.append(tuple(efel.getFeatureNames()))
+    return _feature_names[0]
@@ -0,0 +1,468 @@
+'''
+Persistent store of the eFEL feature values of single traces.
+
+Every trace analyzed by bluepyefe is identified by a digest of its time and
+voltage arrays, its stimulus start and end and the eFEL settings in use
+(spike threshold, stimulus current, ...) when the features are computed
+(see trace_key). The store keeps the value of every (trace, feature) pair.
+
+Two stores are used:
+ - the feature cube (STORE_PATH), filled at ingest time (see build_cube):
+   the default extraction is run on every cell of the repository computing
+   all the eFEL features not listed in FEATUREEXCLUDE
+ - the feature memo (MEMO_PATH), where extraction jobs record every value
+   they compute. Its size is bounded: the least recently used values are
+   evicted when the store grows beyond MEMO_MAX_SIZE bytes. The total size
+   of the values is kept in the meta table, updated by every store
+
+Extraction jobs install both stores in front of efel.getFeatureValues (see
+install), so that the stored values are used and only the missing features
+are computed.
+'''
+
+import os
+import json
+import shutil
+import sqlite3
+import time
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+import numpy as np
+import efel
+import matplotlib
+matplotlib.use('Agg')
+import bluepyefe as bpefe
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH = os.path.join(settings.MEDIA_ROOT, 'efel_data', 'app_data', \
+        'feature_store.sqlite')
+MEMO_PATH = os.path.join(settings.MEDIA_ROOT, 'efel_data', 'app_data', \
+        'feature_memo.sqlite')
+MEMO_MAX_SIZE = 1 << 30
+CONF_PATH = os.path.join(settings.BASE_DIR, 'efelg', 'config', \
+        'pt_conf.json')
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS features (
+        trace TEXT, feature TEXT, value TEXT, size INTEGER, atime REAL,
+        PRIMARY KEY (trace, feature)
+    )''',
+    '''CREATE INDEX IF NOT EXISTS features_atime ON features (atime)''',
+    '''CREATE TABLE IF NOT EXISTS traces (
+        trace TEXT PRIMARY KEY, md5 TEXT, label TEXT
+    )''',
+    '''CREATE INDEX IF NOT EXISTS traces_md5 ON traces (md5, label)''',
+    '''CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)''',
+]
+
+# number of rows removed at a time when evicting values
+EVICT_BATCH = 1000
+
+# fraction of max_size the store is brought back to when evicting, so that
+# eviction does not run again at every store
+EVICT_TARGET = 0.9
+
+
+def connect(path=STORE_PATH):
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    # stores written before the size total was kept
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'size'").fetchone() \
+            is None:
+        conn.execute("INSERT OR IGNORE INTO meta SELECT 'size', " + \
+                "COALESCE(SUM(size), 0) FROM features")
+    return conn
+
+
+# return the key of a trace (a dictionary in the efel.getFeatureValues
+# format) analyzed with the given eFEL settings
+def trace_key(trace, efel_settings):
+    key = hashlib.sha1()
+    for name in ['T', 'V']:
+        key.update(np.ascontiguousarray(trace[name], dtype=np.float64) \
+                .tobytes())
+    key.update(json.dumps([[float(i) for i in trace['stim_start']], \
+            [float(i) for i in trace['stim_end']], \
+            sorted(efel_settings.items())]).encode('utf-8'))
+    return key.hexdigest()
+
+
+def encode_value(value):
+    if value is None:
+        return json.dumps(None)
+    value = np.asarray(value)
+    return json.dumps([value.dtype.str, value.tolist()])
+
+
+def decode_value(value):
+    value = json.loads(value)
+    if value is None:
+        return None
+    return np.array(value[1], dtype=value[0])
+
+
+class FeatureStore(object):
+    '''
+    Feature values of single traces, kept in the SQLite file path. If
+    max_size is given, the least recently used values are evicted when the
+    size of the stored values exceeds max_size bytes
+    '''
+
+    def __init__(self, path=STORE_PATH, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self._conn = None
+        self._pid = None
+
+    # return the connection of the current process, opened on first use.
+    # Connections are not shared with the forked processes
+    def connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = connect(self.path)
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    # return {feature: value} of the stored features of the trace
+    def lookup(self, key, feature_names):
+        values = {}
+        conn = self.connection()
+        for i in range(0, len(feature_names), 500):
+            crr_names = list(feature_names[i:i + 500])
+            query = 'SELECT feature, value FROM features ' + \
+                    'WHERE trace = ? AND feature IN (%s)' % \
+                    ', '.join('?' * len(crr_names))
+            for feature, value in conn.execute(query, [key] + crr_names):
+                values[feature] = decode_value(value)
+        if values and self.max_size:
+            conn.execute('UPDATE features SET atime = ? ' + \
+                    'WHERE trace = ?', (time.time(), key))
+        return values
+
+    # store the {feature: value} of a trace, identified (if known) by the
+    # md5 of its file and its stimulus label too
+    def store(self, key, values, md5=None, label=None):
+        conn = self.connection()
+        atime = time.time()
+        rows = []
+        for feature, value in values.items():
+            value = encode_value(value)
+            rows.append((key, feature, value, len(value), atime))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # the replaced values no longer count in the total size
+            replaced = 0
+            for i in range(0, len(rows), 500):
+                crr_names = [row[1] for row in rows[i:i + 500]]
+                replaced += conn.execute('SELECT COALESCE(SUM(size), 0) ' + \
+                        'FROM features WHERE trace = ? AND feature IN (%s)' % \
+                        ', '.join('?' * len(crr_names)), [key] + crr_names) \
+                        .fetchone()[0]
+            conn.executemany('INSERT OR REPLACE INTO features ' + \
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+            if md5:
+                conn.execute('INSERT OR REPLACE INTO traces VALUES (?, ?, ?)', \
+                        (key, md5, label))
+            conn.execute("UPDATE meta SET value = value + ? " + \
+                    "WHERE key = 'size'", \
+                    (sum(row[3] for row in rows) - replaced,))
+            if self.max_size:
+                self.evict(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    # return the total size of the stored values
+    def size(self, conn=None):
+        conn = conn or self.connection()
+        return conn.execute("SELECT value FROM meta WHERE key = 'size'") \
+                .fetchone()[0]
+
+    # if the size of the store exceeds max_size, remove the least recently
+    # used values until it is below EVICT_TARGET * max_size. Run in the
+    # transaction of store
+    def evict(self, conn):
+        size = self.size(conn)
+        if size <= self.max_size:
+            return
+        target = self.max_size * EVICT_TARGET
+        removed = 0
+        while size - removed > target:
+            rows = conn.execute('SELECT rowid, size FROM features ' + \
+                    'ORDER BY atime LIMIT ?', (EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for rowid, crr_size in rows:
+                if size - removed <= target:
+                    break
+                evicted.append((rowid,))
+                removed += crr_size
+            conn.executemany('DELETE FROM features WHERE rowid = ?', evicted)
+        conn.execute("UPDATE meta SET value = value - ? WHERE key = 'size'", \
+                (removed,))
+        conn.execute('DELETE FROM traces WHERE trace NOT IN ' + \
+                '(SELECT trace FROM features)')
+
+    # check whether the traces of a file have already been stored
+    def has_file(self, md5):
+        return self.connection().execute('SELECT 1 FROM traces ' + \
+                'WHERE md5 = ? LIMIT 1', (md5,)).fetchone() is not None
+
+
+# feature stores used in the current process, by path
+_stores = {}
+
+
+# return the FeatureStore of path, shared within the current process so that
+# its connection is reused
+def open_store(path=STORE_PATH, max_size=None):
+    if path not in _stores:
+        _stores[path] = FeatureStore(path, max_size)
+    _stores[path].max_size = max_size
+    return _stores[path]
+
+
+class EfelMemo(object):
+    '''
+    Wrapper of efel.getFeatureValues reading the feature values from a list
+    of FeatureStore and computing the missing ones only. The computed
+    values are added to record_store, if given. The eFEL settings are
+    tracked by wrapping the eFEL setters
+    '''
+
+    SETTERS = ['setThreshold', 'setDerivativeThreshold', 'setIntSetting', \
+            'setDoubleSetting', 'setStrSetting']
+
+    def __init__(self, feature_stores, record_store=None):
+        self.feature_stores = feature_stores
+        self.record_store = record_store
+        self.settings = {}
+        # md5 of the file being analyzed, stored with the traces if set
+        self.md5 = None
+        self.originals = {}
+
+    def install(self):
+        for name in self.SETTERS + ['reset', 'getFeatureValues']:
+            if hasattr(efel, name):
+                self.originals[name] = getattr(efel, name)
+        for name in self.SETTERS:
+            if name in self.originals:
+                setattr(efel, name, self._setter(name))
+        efel.reset = self.reset
+        efel.getFeatureValues = self.get_feature_values
+
+    def uninstall(self):
+        for name, function in self.originals.items():
+            setattr(efel, name, function)
+        self.originals = {}
+        if self in _installed:
+            _installed.remove(self)
+
+    def _setter(self, name):
+        def setter(*args):
+            update_settings(self.settings, name, args)
+            return self.originals[name](*args)
+        return setter
+
+    def reset(self):
+        self.settings = {}
+        return self.originals['reset']()
+
+    # return {feature: value} of the features of the trace available in the
+    # feature stores
+    def lookup(self, key, feature_names):
+        values = {}
+        for feature_store in self.feature_stores:
+            missing = [i for i in feature_names if i not in values]
+            if not missing:
+                break
+            try:
+                values.update(feature_store.lookup(key, missing))
+            except sqlite3.Error as e:
+                logger.warning("feature store unavailable: %s", e)
+        return values
+
+    def get_feature_values(self, traces, feature_names, *args, **kwargs):
+        # only the default (list) output is supported
+        if args or kwargs.get('parallel_map') or \
+                not kwargs.get('return_list', True):
+            return self.originals['getFeatureValues'](traces, \
+                    feature_names, *args, **kwargs)
+
+        results = []
+        for trace in traces:
+            key = trace_key(trace, self.settings)
+            values = self.lookup(key, feature_names)
+
+            missing = [i for i in feature_names if i not in values]
+            if missing:
+                values.update(self.originals['getFeatureValues']([trace], \
+                        missing, **kwargs)[0])
+                if self.record_store:
+                    self._store(key, dict((i, values[i]) for i in missing), \
+                            self.settings)
+
+            results.append(dict((i, values[i]) for i in feature_names))
+
+        return results
+
+    def prefetch(self, items, map_function=map):
+        '''
+        Compute and record the features of a batch of traces, distributing
+        the traces with map_function (e.g. the map of a multiprocessing
+        pool). items is a list of (trace, feature names, eFEL setter
+        calls), the setter calls being the (setter name, arguments) with
+        which the trace is going to be analyzed by efel.getFeatureValues
+        '''
+
+        todo = []
+        for trace, feature_names, calls in items:
+            crr_settings = dict(self.settings)
+            for name, args in calls:
+                update_settings(crr_settings, name, args)
+            key = trace_key(trace, crr_settings)
+            values = self.lookup(key, feature_names)
+            missing = [i for i in feature_names if i not in values]
+            if missing:
+                todo.append((key, crr_settings, (trace, missing, calls)))
+
+        results = map_function(compute_features, [i[2] for i in todo])
+        for (key, crr_settings, args), values in zip(todo, results):
+            self._store(key, values, crr_settings)
+
+        return len(todo)
+
+    def _store(self, key, values, crr_settings):
+        label = None
+        if 'stimulus_current' in crr_settings:
+            label = "{0:.2f}".format(crr_settings['stimulus_current'])
+        try:
+            self.record_store.store(key, values, self.md5, label)
+        except sqlite3.Error as e:
+            logger.warning("feature store unavailable: %s", e)
+
+
+# update the eFEL settings dictionary with a call to the setter name
+def update_settings(efel_settings, name, args):
+    if name in ['setThreshold', 'setDerivativeThreshold']:
+        efel_settings[name] = args[0]
+    else:
+        efel_settings[args[0]] = args[1]
+
+
+# memo installed in the current process, if any
+_installed = []
+
+
+# install the feature stores in front of eFEL in the current process (and
+# in the processes forked from it)
+def install(feature_stores, record_store=None):
+    memo = EfelMemo(feature_stores, record_store)
+    memo.install()
+    _installed[:] = [memo]
+    return memo
+
+
+# compute the features of a trace with the given eFEL setter calls, run by
+# the worker processes of EfelMemo.prefetch
+def compute_features(args):
+    trace, feature_names, calls = args
+    functions = _installed[0].originals if _installed else vars(efel)
+    for name, crr_args in calls:
+        functions[name](*crr_args)
+    return functions['getFeatureValues']([trace], feature_names, \
+            raise_warnings=False)[0]
+
+
+# return the features computed for the feature cube, i.e. all the eFEL
+# features not excluded in the feature configuration file
+def cube_features(conf_path=CONF_PATH):
+    with open(conf_path) as f:
+        exclude = json.load(f).get('FEATUREEXCLUDE', [])
+    return [i for i in efel.getFeatureNames() if i not in exclude]
+
+
+# compute the features of all the traces of a .json trace file, run by the
+# worker processes of build_cube
+def cube_file(args):
+    json_path, features, path = args
+    # imported here since extraction imports this module
+    from . import extraction
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        with open(json_path) as f:
+            data = json.load(f)
+        feature_store = open_store(path)
+        if feature_store.has_file(data['md5']):
+            return (json_path, None)
+
+        name = os.path.basename(json_path)[:-5]
+        target = sorted(float(i) for i in data['traces'])
+        config = {
+            'features': {'step': features},
+            'path': os.path.dirname(json_path),
+            'format': 'ibf_json',
+            'comment': [],
+            'cells': {name: {'v_corr': 0, 'ljp': 0, 'experiments': \
+                    {'step': {'location': 'soma', 'files': [name]}}, \
+                    'etype': 'etype', 'exclude': [[]], \
+                    'exclude_unit': [data['amp_unit']]}},
+            'options': extraction.default_options(target),
+        }
+        config['options']['print_table']['flag'] = False
+
+        memo = install([feature_store], record_store=feature_store)
+        memo.md5 = data['md5']
+        try:
+            extractor = bpefe.Extractor(work_dir, config, use_git=False)
+            extractor.create_dataset()
+            extractor.extract_features()
+        finally:
+            memo.uninstall()
+        return (json_path, None)
+    except Exception as e:
+        return (json_path, str(e))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def build_cube(json_dir, path=STORE_PATH, conf_path=CONF_PATH, \
+        processes=None):
+    '''
+    Store the features of all the traces of the .json files of json_dir
+    not stored yet. Return the list of (file, error message) of the files
+    that could not be analyzed
+    '''
+
+    features = cube_features(conf_path)
+    # create the store before starting the workers
+    connect(path).close()
+
+    args = [(os.path.join(json_dir, i), features, path) for i in \
+            sorted(os.listdir(json_dir)) if i.endswith('.json')]
+    errors = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        for json_path, error in pool.imap_unordered(cube_file, args):
+            if error:
+                logger.error("%s: %s", json_path, error)
+                errors.append((json_path, error))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return errors
@@ -12,6 +12,26 @@ from . import stimulus_extraction
 
 logger = logging.getLogger(__name__)
 
+# dtype of the voltage arrays kept in memory
+DTYPE = np.float64
+
+
+# a sweep of a recording: its stimulus label, its voltage as a contiguous
+# array and the onset/offset lists of its stimulus
+class Trace(object):
+
+    __slots__ = ('label', 'voltage', 'ton', 'toff')
+
+    def __init__(self, label, voltage, ton, toff):
+        self.label = label
+        self.voltage = np.ascontiguousarray(voltage, dtype=DTYPE)
+        self.ton = ton
+        self.toff = toff
+
+    def tonoff(self):
+        return {'ton': self.ton, 'toff': self.toff}
+
+
 # generate hash md5 code for the filename passed as parameter
 def md5(filename):
     hash_md5 = hashlib.md5()
@@ -21,15 +41,44 @@ def md5(filename):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
-# generate data strcuture containing data and metadata
-def gen_data_struct(filename, filename_meta, upload_flag = False):
+# open an .abf file parsing its header only: the signals are memory mapped
+# but not decoded until read_abf is called
+def open_abf(filename):
+    return neo.io.AxonIO(filename)
+
+
+# return the units of the recorded channels of an opened .abf file
+def abf_units(reader):
+    return [str(u) for u in reader.header['signal_channels']['units']]
+
+
+# decode the signals of an .abf file, returning (header, segments). The
+# reader returned by open_abf can be passed to avoid parsing the header
+# again. The result can be passed to gen_data_struct, so that the file is
+# only read once
+def read_abf(filename, reader = None):
+    if reader is None:
+        reader = open_abf(filename)
+    segments = reader.read_block().segments
+    header = reader._axon_info
+    return (header, segments)
+
+
+# generate data strcuture containing data and metadata. The sweeps are kept
+# as a list of Trace, they are converted to lists only when written as json
+# (see write_json). If the file has already been read (see read_abf) or
+# hashed, the results can be passed as abf and md5sum
+def gen_data_struct(filename, filename_meta, upload_flag = False, \
+        abf = None, md5sum = None):
     c_species, c_area, c_region, c_type, c_etype, c_name, c_sample = \
             get_cell_info(filename_meta, upload_flag)
-    sampling_rate, tonoff, traces, volt_unit, amp_unit = \
-            get_traces_info(filename, upload_flag)
+    sampling_rate, traces, volt_unit, amp_unit = \
+            get_traces_info(filename, upload_flag, abf)
+    if md5sum is None:
+        md5sum = md5(filename)
     obj = {
         'abfpath': filename,
-        'md5': md5(filename),
+        'md5': md5sum,
         'species': c_species,
         'area': c_area,
         'region': c_region,
@@ -40,7 +89,6 @@ def gen_data_struct(filename, filename_meta, upload_flag = False):
         'volt_unit': volt_unit,
         'amp_unit': amp_unit,
         'traces': traces,
-        'tonoff': tonoff,
         'sampling_rate': sampling_rate,
         'contributors': {'name':"", 'message':""}
     }
@@ -112,15 +160,14 @@ def get_cell_info(filename, upload_flag=False):
 
     return (c_species, c_area, c_region, c_type, c_etype, c_name, c_sample) 
 
-# extract data info (i.e. voltage trace, stimulus and stimulus unit) from experimental and metadata files
-def get_traces_info(filename, upload_flag = False):
+# extract data info (i.e. voltage trace, stimulus and stimulus unit) from experimental and metadata files.
+# The sweeps are returned as a list of Trace
+def get_traces_info(filename, upload_flag = False, abf = None):
     
     #
-    data = neo.io.AxonIO(filename)
-    bl = data.read_block()
-    segments = bl.segments
-    data._parse_header()
-    header = data._axon_info
+    if abf is None:
+        abf = read_abf(filename)
+    header, segments = abf
     sampling_rate = 1.e6 / header['protocol']['fADCSequenceInterval'] # read sampling rate
 
     #
@@ -130,30 +177,117 @@ def get_traces_info(filename, upload_flag = False):
     # extract stimulus
     if not upload_flag:
         crr_dict = get_metadata(filename)
-        stim_res = stimulus_extraction.stim_feats_from_meta(crr_dict, len(segments))
+        stim_res = stimulus_extraction.stim_array_from_meta(crr_dict, len(segments))
         if not stim_res[0]:
-            stim_res = stimulus_extraction.stim_feats_from_header(header)
+            stim_res = stimulus_extraction.stim_array_from_header(header)
         if not stim_res[0]:
             return 0
         stim = stim_res[1]
     else:
-        stim_res = stimulus_extraction.stim_feats_from_header(header)
+        stim_res = stimulus_extraction.stim_array_from_header(header)
         stim = stim_res[1]
     
-    amp_unit = stim[0][-1]
+    amp_unit = stim['unit'][0]
+    stim_start = stim['start'].tolist()
+    stim_end = stim['end'].tolist()
+    stim_labels = ["{0:.2f}".format(k) for k in stim['amplitude']]
    
-    # build dictionaries 
-    traces = {}
-    tonoff = {}
+    # build the sweeps, one array per sweep
+    traces = []
     for i, signal in enumerate(segments):
-        voltage = np.array(signal.analogsignals[0]).astype(np.float64)
-        voltage = [k[0] for k in voltage]
-        stimulus = stim[i][3]
-        label = "{0:.2f}".format(np.around(stimulus, decimals=3))
-        traces.update({label: voltage})
-        tonoff.update({label: {'ton': [stim[i][1]], 'toff': [stim[i][2]]}})
-
-    return (sampling_rate, tonoff, traces, volt_unit, amp_unit)
+        voltage = np.asarray(signal.analogsignals[0].magnitude)[:, 0]
+        traces.append(Trace(stim_labels[i], voltage, [stim_start[i]], \
+                [stim_end[i]]))
+
+    return (sampling_rate, traces, volt_unit, amp_unit)
+
+
+# return the {stimulus label: {'ton': ..., 'toff': ...}} dictionary of a
+# list of Trace, as stored in the .json files
+def tonoff(traces):
+    return dict((t.label, t.tonoff()) for t in traces)
+
+
+# write a data structure (see gen_data_struct) to the open file f in the
+# .json format read by bluepyefe, i.e. with the traces as
+# {stimulus label: voltage list} and their stimuli in a separate tonoff
+# dictionary. The traces are converted to lists one at a time, so that only
+# one sweep at a time is held as python floats
+def write_json(data, f):
+    meta = dict((k, v) for k, v in data.items() if k != 'traces')
+    meta['tonoff'] = tonoff(data['traces'])
+    f.write('{"traces": {')
+    for i, trace in enumerate(data['traces']):
+        if i:
+            f.write(', ')
+        f.write(json.dumps(trace.label) + ': ' + \
+                json.dumps(trace.voltage.tolist()))
+    f.write('}')
+    for k, v in meta.items():
+        f.write(', ' + json.dumps(k) + ': ' + json.dumps(v))
+    f.write('}')
+
+
+JSON_DECODER = json.JSONDecoder()
+JSON_SPACE = re.compile(r'[ \t\n\r]*')
+
+
+# parse the json object starting at pos in text, parsing the value of every
+# member with parse_value(key, text, pos), which returns (value, end).
+# Return (object, end)
+def parse_object(text, pos, parse_value):
+    pos = JSON_SPACE.match(text, pos).end()
+    if text[pos:pos + 1] != '{':
+        raise ValueError("Expecting object at char %d" % pos)
+    obj = {}
+    pos = JSON_SPACE.match(text, pos + 1).end()
+    if text[pos:pos + 1] == '}':
+        return (obj, pos + 1)
+    while True:
+        key, pos = JSON_DECODER.raw_decode(text, pos)
+        pos = JSON_SPACE.match(text, pos).end()
+        if text[pos:pos + 1] != ':':
+            raise ValueError("Expecting ':' at char %d" % pos)
+        pos = JSON_SPACE.match(text, pos + 1).end()
+        obj[key], pos = parse_value(key, text, pos)
+        pos = JSON_SPACE.match(text, pos).end()
+        if text[pos:pos + 1] == '}':
+            return (obj, pos + 1)
+        if text[pos:pos + 1] != ',':
+            raise ValueError("Expecting ',' at char %d" % pos)
+        pos = JSON_SPACE.match(text, pos + 1).end()
+
+
+# parse the json list of numbers starting at pos in text directly into an
+# array, without building python floats
+def parse_array(text, pos):
+    if text[pos:pos + 1] != '[':
+        raise ValueError("Expecting array at char %d" % pos)
+    end = text.index(']', pos)
+    values = text[pos + 1:end]
+    if not values.strip():
+        return (np.empty(0, dtype=DTYPE), end + 1)
+    return (np.fromstring(values, dtype=DTYPE, sep=','), end + 1)
+
+
+def parse_member(key, text, pos):
+    if key == 'traces':
+        return parse_object(text, pos, lambda k, t, p: parse_array(t, p))
+    return JSON_DECODER.raw_decode(text, pos)
+
+
+# read a .json file written by write_json into a data structure (see
+# gen_data_struct). Every sweep is parsed directly into its array, so that
+# the whole recording is never held as python floats
+def read_json(filepath):
+    with open(filepath) as f:
+        data, end = parse_object(f.read(), 0, parse_member)
+    crr_tonoff = data.pop('tonoff', {})
+    data['traces'] = [Trace(label, voltage, \
+            crr_tonoff.get(label, {}).get('ton'), \
+            crr_tonoff.get(label, {}).get('toff')) \
+            for label, voltage in data['traces'].items()]
+    return data
 
 
 # read metadata file into a json dictionary
@@ -0,0 +1,117 @@
+'''
+Time-to-live cache for the responses of the HBP services (user identity,
+collab context and collab membership).
+
+Entries are kept in a local SQLite file, so that they are shared by all the
+uWSGI workers of the host. Any failure of the cache is logged and the
+caller simply falls back to the remote service.
+'''
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.path.join(settings.MEDIA_ROOT, 'efel_data', 'app_data', \
+        'remote_cache.sqlite')
+DEFAULT_TTL = 300
+
+
+class TTLCache(object):
+
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        return conn
+
+    def get(self, key):
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT value, expires FROM entries '
+                        'WHERE key = ?', (key,)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("remote cache unavailable: %s", e)
+            return None
+
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('INSERT OR REPLACE INTO entries '
+                        'VALUES (?, ?, ?)', \
+                        (key, json.dumps(value), time.time() + ttl))
+                conn.execute('DELETE FROM entries WHERE expires < ?', \
+                        (time.time(),))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("remote cache unavailable: %s", e)
+
+    # remove all the entries whose key starts with prefix
+    def invalidate(self, prefix):
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('DELETE FROM entries '
+                        'WHERE substr(key, 1, ?) = ?', (len(prefix), prefix))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("remote cache unavailable: %s", e)
+
+
+# response-like object returned for cache hits
+class CachedResponse(object):
+
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+cache = TTLCache()
+
+
+# GET url, returning the cached json for key if any. Only successful
+# responses are cached
+def get(url, headers, key):
+    data = cache.get(key)
+    if data is not None:
+        return CachedResponse(data)
+
+    res = requests.get(url, headers = headers)
+    if res.status_code == 200:
+        cache.set(key, res.json())
+    return res
+
+
+# key prefix of all the entries belonging to a user
+def user_prefix(social_auth):
+    return 'user:%s:' % social_auth.uid
+
+
+def invalidate_user(social_auth):
+    cache.invalidate(user_prefix(social_auth))
@@ -0,0 +1,170 @@
+'''
+Incremental (re)build of the efelg trace repository.
+
+Every .abf file in the raw data folder having a companion _metadata.json
+file is converted to the .json file read by bluepyefe and to the binary
+trace store. A manifest keeps (path, size, mtime, md5) of the converted
+files, so that only new or modified recordings are converted again.
+Conversions are distributed over a pool of processes.
+'''
+
+import os
+import json
+import fcntl
+import logging
+import multiprocessing
+from . import manage_json
+from . import trace_store
+from . import trace_index
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'trace_manifest.json'
+AUTHORIZATION_NAME = 'files_authorization.json'
+LOCK_NAME = '.trace_repository.lock'
+
+
+class RepositoryLocked(Exception):
+    pass
+
+
+# write a json file atomically, i.e. readers see either the old or the new
+# content but never a partially written file
+def write_json_atomic(filepath, obj, dump=json.dump):
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filepath, filepath)
+
+
+def read_manifest(app_data_dir):
+    manifest_path = os.path.join(app_data_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+# convert a single .abf file, run by the worker processes. If from_json is
+# set, only the binary store is rebuilt from the existing .json file
+def convert_abf(args):
+    abf_path, metadata_file, json_dir, store_dir, from_json = args
+    try:
+        outfilename = '____'.join(manage_json.get_cell_info(metadata_file))
+        outfilepath = os.path.join(json_dir, outfilename + '.json')
+        if from_json:
+            data = manage_json.read_json(outfilepath)
+        else:
+            data = manage_json.gen_data_struct(abf_path, metadata_file)
+            write_json_atomic(outfilepath, data, manage_json.write_json)
+        trace_store.write_cell(store_dir, outfilename, data)
+        return (abf_path, data['md5'], None)
+    except Exception as e:
+        return (abf_path, None, str(e))
+
+
+# check whether the outputs of a manifest entry are up to date
+def is_up_to_date(entry, stat, json_dir, store_dir):
+    if not entry or entry['size'] != stat.st_size or \
+            entry['mtime'] != stat.st_mtime:
+        return False
+    if not os.path.isfile(os.path.join(json_dir, entry['name'] + '.json')):
+        return False
+    return trace_store.is_current(store_dir, entry['name'])
+
+
+def build_repository(data_dir, json_dir, store_dir, app_data_dir, \
+        index_path=None, processes=None, force=False):
+    '''
+    Convert new or modified .abf files of data_dir, write the files
+    authorization file and, if index_path is given, the metadata index
+    (see trace_index). Return the list of (abf path, error message) of
+    the files that could not be converted.
+    '''
+
+    for crr_dir in [json_dir, store_dir, app_data_dir]:
+        if not os.path.exists(crr_dir):
+            os.makedirs(crr_dir)
+
+    # avoid concurrent builds of the same repository
+    lock_file = open(os.path.join(app_data_dir, LOCK_NAME), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        raise RepositoryLocked("Another build of the repository is running")
+
+    try:
+        manifest = {} if force else read_manifest(app_data_dir)
+        new_manifest = {}
+        files_authorization = {}
+        to_convert = []
+
+        for name in sorted(os.listdir(data_dir)):
+            if not name.endswith('.abf'):
+                continue
+            fname = os.path.splitext(name)[0]
+            metadata_file = os.path.join(data_dir, fname + '_metadata.json')
+            if not os.path.isfile(metadata_file):
+                continue
+
+            abf_path = os.path.join(data_dir, name)
+            outfilename = '____'.join(manage_json.get_cell_info(metadata_file))
+            files_authorization[outfilename + '.json'] = \
+                    manage_json.extract_authorized_collab(metadata_file)
+
+            stat = os.stat(abf_path)
+            entry = manifest.get(abf_path)
+            if entry and entry['name'] == outfilename and \
+                    is_up_to_date(entry, stat, json_dir, store_dir):
+                new_manifest[abf_path] = entry
+                continue
+
+            # files converted before the manifest existed are trusted, as
+            # they used to be, and only their binary store is rebuilt
+            from_json = not entry and not force and os.path.isfile( \
+                    os.path.join(json_dir, outfilename + '.json'))
+            new_manifest[abf_path] = {'name': outfilename, \
+                    'size': stat.st_size, 'mtime': stat.st_mtime, \
+                    'md5': None}
+            if from_json and trace_store.is_current(store_dir, outfilename):
+                new_manifest[abf_path]['md5'] = \
+                        trace_store.read_meta(store_dir, outfilename)['md5']
+            else:
+                to_convert.append((abf_path, metadata_file, json_dir, \
+                        store_dir, from_json))
+
+        logger.info("%d files to be converted out of %d", \
+                len(to_convert), len(new_manifest))
+
+        errors = []
+        if to_convert:
+            pool = multiprocessing.Pool(processes)
+            try:
+                for abf_path, md5, error in \
+                        pool.imap_unordered(convert_abf, to_convert):
+                    if error:
+                        logger.error("%s: %s", abf_path, error)
+                        errors.append((abf_path, error))
+                        new_manifest.pop(abf_path)
+                    else:
+                        new_manifest[abf_path]['md5'] = md5
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        write_json_atomic(os.path.join(app_data_dir, MANIFEST_NAME), \
+                new_manifest)
+        write_json_atomic(os.path.join(app_data_dir, AUTHORIZATION_NAME), \
+                files_authorization)
+        if index_path:
+            trace_index.build_index(index_path, store_dir, \
+                    files_authorization)
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    return errors
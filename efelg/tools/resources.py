@@ -4,8 +4,11 @@ import json
 import collections
 import neo
 import pprint
+import subprocess
 from datetime import datetime
 from . import stimulus_extraction
+from . import remote_cache
+from . import manage_json
 import requests
 from django.conf import settings
 if not settings.DEBUG:
@@ -19,42 +22,48 @@ logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# start the management command args in background, in its own session, with
+# its output appended to log_path. Return the Popen object, raise OSError if
+# the process cannot be started
+def start_management_command(args, log_path):
+    log_file = open(log_path, 'a')
+    try:
+        return subprocess.Popen([settings.BACKGROUND_PYTHON, \
+                os.path.join(settings.BASE_DIR, 'manage.py')] + args, \
+                stdout=log_file, stderr=log_file, close_fds=True, \
+                preexec_fn=os.setsid)
+    finally:
+        log_file.close()
+
+
 def valid_abf_file(filepath):
     #
     try:
-        data = neo.io.AxonIO(filepath)
-        segments = data.read_block(lazy=False, cascade=True).segments
-       
-        assert len(segments[0].analogsignals) >= 2
-            
-        volt_unit = segments[0].analogsignals[0].units
-        volt_unit = str(volt_unit.dimensionality)
-        assert volt_unit == 'mV'
-        
-        amp_unit = segments[0].analogsignals[1].units
-        amp_unit = str(amp_unit.dimensionality)
-        assert amp_unit == 'nA'
+        units = manage_json.abf_units(manage_json.open_abf(filepath))
+        assert len(units) >= 2
+        assert units[0] == 'mV'
+        assert units[1] == 'nA'
 
         return True
     except:
         return False
 
 
-##### check file validity
-def check_file_validity(filepath):
+##### check file validity from the header of the file only, i.e. without
+##### decoding any signal. reader is the object returned by
+##### manage_json.open_abf if the file has already been opened
+def check_file_validity(filepath, reader = None):
     extension = os.path.splitext(os.path.basename(filepath))
     extension = str(extension[1])
     try:
         if extension == '.abf':
-            data = neo.io.AxonIO(filepath)
-            bl = data.read_block()
-            segments = bl.segments
-            volt_unit = segments[0].analogsignals[0].units
-            volt_unit = str(volt_unit.dimensionality)
+            if reader is None:
+                reader = manage_json.open_abf(filepath)
+            volt_unit = manage_json.abf_units(reader)[0]
             pprint.pprint(volt_unit)
             assert volt_unit == 'mV'
-            data._parse_header()
-            header = data._axon_info
+            header = reader._axon_info
+            assert header['lActualEpisodes'] > 0
             pprint.pprint(header)
             stim_res = \
                fa.stim_feats_from_header(header)
@@ -206,7 +215,8 @@ def stim_feats_from_header(self, header):
 def user_collab_list(my_collabs_url, social_auth):
     auth_data_list = []
     headers = {'Authorization': get_auth_header(social_auth)}
-    res_mine = requests.get(my_collabs_url, headers = headers)
+    res_mine = remote_cache.get(my_collabs_url, headers, \
+            remote_cache.user_prefix(social_auth) + 'collabs')
                    
     resp_mine = res_mine.json()
     for i in resp_mine['results']:
@@ -4,9 +4,32 @@ import logging
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
+# fields of the structured arrays returned by stim_array_from_meta and
+# stim_array_from_header, one row per episode
+STIM_DTYPE = [('type', 'O'), ('start', 'f8'), ('end', 'f8'), \
+        ('amplitude', 'f8'), ('unit', 'O')]
+
+
+# build the structured array of the stimuli of all the episodes.
+# Amplitudes are rounded to 3 decimals, as done by the tuple based code
+def stim_array(ty, st, en, amp, u):
+    amp = numpy.asarray(amp, dtype=numpy.float64)
+    all_stim = numpy.empty(len(amp), dtype=STIM_DTYPE)
+    all_stim['type'] = ty
+    all_stim['start'] = st
+    all_stim['end'] = en
+    all_stim['amplitude'] = numpy.round(amp, 3)
+    all_stim['unit'] = u
+    return all_stim
+
+
+# return the (type, start, end, amplitude, unit) tuples of a stimulus array
+def stim_list(all_stim):
+    return all_stim.tolist()
+
 
 # author Luca Leonardo Bologna
-def stim_feats_from_meta(crr_dict, num_segments):
+def stim_array_from_meta(crr_dict, num_segments):
     try:
         # read stimulus information
         ty = str(crr_dict['stimulus_type'])
@@ -24,15 +47,9 @@ def stim_feats_from_meta(crr_dict, num_segments):
     except:
         return (0, [])
 
-    all_stim_feats = []
-    # for every segment in the axon file
-    for i in range(num_segments):
-
-        # compute current stimulus amplitude
-        crr_val = float(format(fa + inc * float(format(i, '.3f')), '.3f'))
-        crr_stim_feats = (ty, st, en, crr_val, u)
-	# store current tuple
-        all_stim_feats.append(crr_stim_feats)
+    # compute the stimulus amplitude of every segment in the axon file
+    all_stim_feats = stim_array(ty, st, en, \
+            fa + inc * numpy.arange(num_segments), u)
 
     logger.info(num_segments)
     logger.info(all_stim_feats)
@@ -41,7 +58,7 @@ def stim_feats_from_meta(crr_dict, num_segments):
 
 
 # author Luca Leonardo Bologna
-def stim_feats_from_header(header):
+def stim_array_from_header(header):
     sampling_rate = 1.e6 / header['protocol']['fADCSequenceInterval'] # read sampling rate
     version = header['fFileVersionNumber'] # read file version
 
@@ -75,7 +92,7 @@ def stim_feats_from_header(header):
                         return (0, "A stimulus different from the steps has been detected")
                 else:
                     ty = "step"
-	            u = stim_ch_info[0][1]
+                    u = stim_ch_info[0][1]
                     nADC = header['sections']['ADCSection']['llNumEntries'] # number of ADC channels
                     nDAC = header['sections']['DACSection']['llNumEntries'] # number of DAC channels
                     nSam = header['protocol']['lNumSamplesPerEpisode']/nADC # number of samples per episode
@@ -87,20 +104,31 @@ def stim_feats_from_header(header):
 
                     i_last = int(nSam*15625/10**6) # index of stimulus beginning
 
-                    all_stim_info = [] # create array for all stimulus info
-
                     e_one_inc = float(format(e_one['fEpochLevelInc'] , '.3f')) # step increment
                     e_one_init_level = float(format(e_one['fEpochInitLevel'] , '.3f')) # step initial level
 
-                    # for every episode, compute stimulus start, stimulus end, stimulus value
-                    for epiNum in range(nEpi):
-                        st = i_last + e_zero['lEpochInitDuration'] + e_zero['lEpochDurationInc'] * epiNum
-                        en = st + e_one['lEpochInitDuration'] +  e_one['lEpochDurationInc'] * epiNum
-                        crr_val_full = float(format(e_one_init_level + e_one_inc * epiNum, '.3f'))
-                        crr_val = float(format(crr_val_full, '.3f'))
-                        st = 1/sampling_rate * st * 1e3
-                        en = 1/sampling_rate * en * 1e3
-                        all_stim_info.append((ty, st, en, crr_val, u))
+                    # compute stimulus start, stimulus end, stimulus value
+                    # of all the episodes at once
+                    epiNum = numpy.arange(nEpi)
+                    st = i_last + e_zero['lEpochInitDuration'] + e_zero['lEpochDurationInc'] * epiNum
+                    en = st + e_one['lEpochInitDuration'] +  e_one['lEpochDurationInc'] * epiNum
+                    st = 1/sampling_rate * st * 1e3
+                    en = 1/sampling_rate * en * 1e3
 
-                    return (1, all_stim_info)
+                    return (1, stim_array(ty, st, en, \
+                            e_one_init_level + e_one_inc * epiNum, u))
 
+
+# tuple based versions of stim_array_from_meta and stim_array_from_header
+def stim_feats_from_meta(crr_dict, num_segments):
+    stim_res = stim_array_from_meta(crr_dict, num_segments)
+    if not stim_res[0]:
+        return stim_res
+    return (1, stim_list(stim_res[1]))
+
+
+def stim_feats_from_header(header):
+    stim_res = stim_array_from_header(header)
+    if not stim_res or not stim_res[0]:
+        return stim_res
+    return (1, stim_list(stim_res[1]))
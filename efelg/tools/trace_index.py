@@ -0,0 +1,283 @@
+'''
+Persistent metadata index of the efelg trace repository.
+
+The index is a SQLite database built at the end of every repository build
+(see repository.build_repository). It holds the metadata of every cell, the
+collab -> file postings coming from files_authorization.json and allows to
+answer get_list without opening any trace file.
+
+The metadata columns are indexed, so that the trace selection page can
+search the cells by facet (see search) instead of loading the whole tree.
+
+Every sweep is also indexed by the amplitude of its stimulus, converted to
+nA whatever the unit of the recording, so that the traces recorded at given
+amplitudes across all the cells can be selected with a single query (see
+stimuli_in_range).
+'''
+
+import os
+import sqlite3
+from . import trace_store
+
+INDEX_NAME = 'trace_index.sqlite'
+
+# metadata columns, in the order of the contributor > ... > cell hierarchy
+HIERARCHY = ['contributor', 'species', 'area', 'region', 'type', 'etype', \
+        'name']
+
+# columns the cells can be filtered by, with the counts of their values
+FACETS = HIERARCHY[:-1]
+
+# columns matched by the free text search
+TEXT_COLUMNS = ['name', 'sample']
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# value in nA of the current units (lower case), as converted by bluepyefe
+AMP_UNITS = {'a': 1e9, 'da': 1e8, 'ca': 1e7, 'ma': 1e6, 'ua': 1e3, \
+        'na': 1., 'pa': 1e-3}
+
+SCHEMA = [
+    '''CREATE TABLE cells (
+        file TEXT PRIMARY KEY,
+        contributor TEXT, species TEXT, area TEXT, region TEXT,
+        type TEXT, etype TEXT, name TEXT, sample TEXT,
+        md5 TEXT, amp_unit TEXT, public INTEGER
+    )''',
+    '''CREATE TABLE collabs (collab TEXT, file TEXT)''',
+    '''CREATE INDEX collabs_collab ON collabs (collab)''',
+    '''CREATE TABLE stimuli (
+        file TEXT, label TEXT, amp_unit TEXT, amplitude REAL,
+        amplitude_na REAL, ton REAL, toff REAL
+    )''',
+    '''CREATE INDEX stimuli_amplitude ON stimuli (amplitude_na)''',
+] + ['''CREATE INDEX cells_%s ON cells (%s)''' % (i, i) for i in FACETS]
+
+
+def connect(index_path):
+    return sqlite3.connect(index_path)
+
+
+def build_index(index_path, store_dir, files_authorization):
+    '''
+    Build the index of the cells available in store_dir, with the
+    authorizations in files_authorization ({file name: [collab ids]})
+    '''
+
+    tmp_index_path = index_path + '.tmp'
+    if os.path.isfile(tmp_index_path):
+        os.remove(tmp_index_path)
+
+    conn = connect(tmp_index_path)
+    try:
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+        for json_name, collabs in files_authorization.items():
+            name = json_name[:-5]
+            if not trace_store.exists(store_dir, name):
+                continue
+            meta = trace_store.read_meta(store_dir, name)
+            public = 1 if collabs and collabs[0] == "all" else 0
+            conn.execute('INSERT INTO cells VALUES (%s)' % \
+                    ', '.join('?' * 12), (name, \
+                    meta['contributors']['name'], meta['species'], \
+                    meta['area'], meta['region'], meta['type'], \
+                    meta['etype'], meta['name'], meta['sample'], \
+                    meta['md5'], meta['amp_unit'], public))
+            conn.executemany('INSERT INTO collabs VALUES (?, ?)', \
+                    [(str(c), name) for c in collabs])
+            conn.executemany('INSERT INTO stimuli VALUES (%s)' % \
+                    ', '.join('?' * 7), stimulus_rows(name, meta))
+
+        conn.commit()
+    finally:
+        conn.close()
+
+    # replace the old index atomically
+    os.rename(tmp_index_path, index_path)
+
+
+# return the value in nA of amp_unit, raise ValueError if unknown
+def amp_factor(amp_unit):
+    try:
+        return AMP_UNITS[str(amp_unit).lower()]
+    except KeyError:
+        raise ValueError("Unknown current unit: %s" % amp_unit)
+
+
+# return the stimuli table rows of a cell, from its trace store metadata.
+# The stimulus labels are the amplitudes formatted with two decimals (see
+# manage_json.get_traces_info), in the amp_unit of the cell. The sweeps of
+# cells with an unknown unit are not indexed
+def stimulus_rows(name, meta):
+    try:
+        factor = amp_factor(meta['amp_unit'])
+    except ValueError:
+        return []
+    rows = []
+    for label in meta['traces']:
+        try:
+            amplitude = float(label)
+        except ValueError:
+            continue
+        crr_tonoff = meta['tonoff'].get(label, {})
+        ton = crr_tonoff.get('ton') or [None]
+        toff = crr_tonoff.get('toff') or [None]
+        rows.append((name, label, meta['amp_unit'], amplitude, \
+                amplitude * factor, ton[0], toff[0]))
+    return rows
+
+
+# return the names of the files accessible by the members of collab_list
+def authorized_files(conn, collab_list):
+    collab_list = [str(c) for c in collab_list]
+    query = 'SELECT file FROM cells WHERE public = 1'
+    if collab_list:
+        query += ' UNION SELECT file FROM collabs WHERE collab IN (%s)' % \
+                ', '.join('?' * len(collab_list))
+    return sorted(row[0] for row in conn.execute(query, collab_list))
+
+
+# return the sql condition (and its parameters) selecting the cells
+# accessible by the members of collab_list, the cells table being aliased
+# as alias if given
+def authorized_condition(collab_list, alias=''):
+    collab_list = [str(c) for c in collab_list]
+    prefix = alias + '.' if alias else ''
+    if not collab_list:
+        return (prefix + 'public = 1', [])
+    return ('(%spublic = 1 OR %sfile IN (SELECT file FROM collabs WHERE ' \
+            'collab IN (%s)))' % (prefix, prefix, \
+            ', '.join('?' * len(collab_list))), collab_list)
+
+
+# escape the LIKE wildcards of a free text query
+def like_pattern(text):
+    text = text.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+    return '%' + text + '%'
+
+
+def search(conn, collab_list, filters=None, text=None, offset=0, \
+        limit=PAGE_SIZE):
+    '''
+    Return one page of the cells accessible by the members of collab_list,
+    matching filters ({facet: [accepted values]}) and text (matched on the
+    cell name and sample), with the counts of the values of every facet.
+    The counts of a facet are computed without the filter on the facet
+    itself, so that they give the results of selecting another value
+    '''
+
+    filters = dict((k, v) for k, v in (filters or {}).items() \
+            if k in FACETS and v)
+    auth_where, auth_params = authorized_condition(collab_list)
+    base = [(auth_where, auth_params)]
+    if text:
+        pattern = like_pattern(text)
+        base.append(('(%s)' % ' OR '.join("%s LIKE ? ESCAPE '\\'" % i \
+                for i in TEXT_COLUMNS), [pattern] * len(TEXT_COLUMNS)))
+    facet_conditions = dict((k, ('%s IN (%s)' % (k, ', '.join('?' * \
+            len(v))), list(v))) for k, v in filters.items())
+
+    def where(conditions):
+        return ' AND '.join(c[0] for c in conditions), \
+                [p for c in conditions for p in c[1]]
+
+    where_sql, params = where(base + list(facet_conditions.values()))
+    total = conn.execute('SELECT COUNT(*) FROM cells WHERE ' + where_sql, \
+            params).fetchone()[0]
+    columns = ['file'] + HIERARCHY + ['sample', 'amp_unit']
+    rows = conn.execute('SELECT %s FROM cells WHERE %s ORDER BY file ' \
+            'LIMIT ? OFFSET ?' % (', '.join(columns), where_sql), \
+            params + [limit, offset])
+    cells = [dict(zip(columns, row)) for row in rows]
+
+    facets = {}
+    for facet in FACETS:
+        facet_sql, facet_params = where(base + [c for k, c in \
+                facet_conditions.items() if k != facet])
+        facets[facet] = [list(row) for row in conn.execute( \
+                'SELECT %s, COUNT(*) FROM cells WHERE %s GROUP BY %s ' \
+                'ORDER BY %s' % (facet, facet_sql, facet, facet), \
+                facet_params)]
+
+    return {'total': total, 'offset': offset, 'limit': limit, \
+            'cells': cells, 'facets': facets}
+
+
+def stimuli_in_range(conn, collab_list, targets, tolerance, amp_unit='nA', \
+        files=None):
+    '''
+    Return the sweeps accessible by the members of collab_list (restricted
+    to files, if given) whose stimulus amplitude is within tolerance of one
+    of the targets. As in the extraction options, targets and tolerance are
+    in amp_unit and the tolerance is absolute and either one value or one
+    value per target. The sweeps are compared in nA, whatever the unit they
+    were recorded in. Every sweep is returned as a dictionary, with its
+    amplitude in its own amp_unit and the targets it matches
+    '''
+
+    if not targets:
+        return []
+    factor = amp_factor(amp_unit)
+    if isinstance(tolerance, (list, tuple)):
+        tolerances = [float(i) for i in tolerance]
+    else:
+        tolerances = [float(tolerance)] * len(targets)
+    ranges = [((float(t) - tol) * factor, (float(t) + tol) * factor) for \
+            t, tol in zip(targets, tolerances)]
+
+    auth_where, params = authorized_condition(collab_list, 'c')
+    query = 'SELECT s.file, s.label, s.amp_unit, s.amplitude, ' \
+            's.amplitude_na, s.ton, s.toff FROM stimuli s JOIN cells c ' \
+            'ON c.file = s.file WHERE (%s) AND %s' % (' OR '.join( \
+            's.amplitude_na BETWEEN ? AND ?' for r in ranges), auth_where)
+    params = [b for r in ranges for b in r] + params
+    if files is not None:
+        files = list(files)
+        if not files:
+            return []
+        query += ' AND s.file IN (%s)' % ', '.join('?' * len(files))
+        params += files
+    query += ' ORDER BY s.file, s.amplitude_na'
+
+    columns = ['file', 'label', 'amp_unit', 'amplitude', 'amplitude_na', \
+            'ton', 'toff']
+    stimuli = []
+    for row in conn.execute(query, params):
+        crr_stim = dict(zip(columns, row))
+        amplitude_na = crr_stim.pop('amplitude_na')
+        crr_stim['targets'] = [float(t) for t, (low, high) in \
+                zip(targets, ranges) if low <= amplitude_na <= high]
+        stimuli.append(crr_stim)
+    return stimuli
+
+
+# group sweeps (see stimuli_in_range) by file, in the {file: {'stim':
+# [labels]}} format of the traces selected for the extraction
+def selection(stimuli):
+    selected = {}
+    for crr_stim in stimuli:
+        selected.setdefault(crr_stim['file'], {'stim': []})['stim'] \
+                .append(crr_stim['label'])
+    return selected
+
+
+# build the contributor > species > ... > cell > [files] tree used by the
+# trace selection page for the given files
+def generate_json_output(conn, file_list):
+    output_file = {"Contributors": {}}
+    file_set = set(file_list)
+
+    query = 'SELECT file, %s FROM cells ORDER BY file' % ', '.join(HIERARCHY)
+    for row in conn.execute(query):
+        if row[0] not in file_set:
+            continue
+        node = output_file["Contributors"]
+        for key in row[1:-1]:
+            node = node.setdefault(key, {})
+        node.setdefault(row[-1], []).append(row[0] + '.json')
+
+    return output_file
@@ -0,0 +1,267 @@
+'''
+Binary trace store.
+
+Every cell is stored as one raw little-endian array file containing all the
+sweeps one after the other, plus a small .json sidecar holding the cell
+metadata and the (offset, length) of every sweep in the array file.
+Readers open the array file via numpy.memmap, so only the pages that are
+actually sliced are read from disk.
+
+Next to the full resolution data, a pyramid of min/max envelopes is stored
+for every sweep (see minmax_envelope), so that traces can be displayed at a
+reduced number of points without losing the spikes.
+'''
+
+import os
+import math
+import json
+import numpy as np
+
+STORE_VERSION = 2
+DATA_EXT = '.dat'
+PYRAMID_EXT = '.pyr.dat'
+META_EXT = '.meta.json'
+DTYPE = '<f8'
+
+# first (i.e. finest) pyramid level and minimum number of bins per level
+PYRAMID_MIN_FACTOR = 4
+PYRAMID_MIN_BINS = 256
+
+# metadata fields copied from the data structure to the sidecar
+META_FIELDS = ['abfpath', 'md5', 'species', 'area', 'region', 'type', \
+        'etype', 'name', 'sample', 'volt_unit', 'amp_unit', \
+        'sampling_rate', 'contributors']
+
+
+def data_path(store_dir, name):
+    return os.path.join(store_dir, name + DATA_EXT)
+
+
+def pyramid_path(store_dir, name):
+    return os.path.join(store_dir, name + PYRAMID_EXT)
+
+
+def meta_path(store_dir, name):
+    return os.path.join(store_dir, name + META_EXT)
+
+
+# check whether a cell is available in the store
+def exists(store_dir, name):
+    return os.path.isfile(meta_path(store_dir, name)) and \
+            os.path.isfile(data_path(store_dir, name))
+
+
+# check whether a cell has been written with the current store layout
+def is_current(store_dir, name):
+    if not exists(store_dir, name):
+        return False
+    return read_meta(store_dir, name).get('version') == STORE_VERSION
+
+
+# return the first folder (among dirs) containing the cell, None otherwise
+def find_cell(name, dirs):
+    for crr_dir in dirs:
+        if crr_dir and exists(crr_dir, name):
+            return crr_dir
+    return None
+
+
+# write the data structure generated by manage_json.gen_data_struct, whose
+# sweeps are a list of manage_json.Trace
+def write_cell(store_dir, name, data, dtype=DTYPE):
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    meta = dict((k, data[k]) for k in META_FIELDS if k in data)
+    meta['version'] = STORE_VERSION
+    meta['dtype'] = dtype
+    meta['tonoff'] = dict((t.label, t.tonoff()) for t in data['traces'])
+    meta['traces'] = {}
+    meta['pyramid'] = []
+
+    # write to temporary files first, so that readers never see a
+    # partially written cell
+    crr_data_path = data_path(store_dir, name)
+    crr_pyramid_path = pyramid_path(store_dir, name)
+    crr_meta_path = meta_path(store_dir, name)
+    tmp_data_path = crr_data_path + '.tmp'
+    tmp_pyramid_path = crr_pyramid_path + '.tmp'
+    tmp_meta_path = crr_meta_path + '.tmp'
+
+    # all the sweeps share the same levels, based on the longest one
+    factors = pyramid_factors(max([len(t.voltage) for t in data['traces']] \
+            or [0]))
+
+    offset = 0
+    pyr_offset = 0
+    levels = {}
+    with open(tmp_data_path, 'wb') as f, open(tmp_pyramid_path, 'wb') as pf:
+        for trace in data['traces']:
+            label = trace.label
+            voltage = np.asarray(trace.voltage, dtype=dtype)
+            f.write(voltage.tobytes())
+            meta['traces'][label] = [offset, len(voltage)]
+            offset += len(voltage)
+
+            # write all the envelopes of the current sweep
+            for factor in factors:
+                envelope = minmax_envelope(voltage, factor)
+                pf.write(envelope.tobytes())
+                levels.setdefault(factor, {})[label] = \
+                        [pyr_offset, len(envelope)]
+                pyr_offset += len(envelope)
+
+    for factor in sorted(levels):
+        meta['pyramid'].append({'factor': factor, 'traces': levels[factor]})
+
+    with open(tmp_meta_path, 'w') as f:
+        json.dump(meta, f)
+
+    os.rename(tmp_data_path, crr_data_path)
+    os.rename(tmp_pyramid_path, crr_pyramid_path)
+    os.rename(tmp_meta_path, crr_meta_path)
+
+    return meta
+
+
+# read the metadata sidecar of a cell
+def read_meta(store_dir, name):
+    with open(meta_path(store_dir, name)) as f:
+        return json.load(f)
+
+
+# return a dictionary {stimulus label: memory mapped voltage array}
+def open_traces(store_dir, name, meta=None):
+    if meta is None:
+        meta = read_meta(store_dir, name)
+
+    traces = {}
+    if not meta['traces']:
+        return traces
+
+    mm = np.memmap(data_path(store_dir, name), dtype=meta['dtype'], \
+            mode='r')
+    for label, (offset, length) in meta['traces'].items():
+        traces[label] = mm[offset:offset + length]
+
+    return traces
+
+
+# return the decimation factors of the pyramid levels for a sweep
+def pyramid_factors(length):
+    factors = []
+    factor = PYRAMID_MIN_FACTOR
+    while int(math.ceil(length / float(factor))) >= PYRAMID_MIN_BINS:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+# split the voltage in bins of 'factor' samples and keep, for every bin,
+# the minimum and the maximum value in the order in which they occur
+def minmax_envelope(voltage, factor):
+    voltage = np.asarray(voltage)
+    nbins = int(math.ceil(len(voltage) / float(factor)))
+    pad = nbins * factor - len(voltage)
+    if pad:
+        voltage = np.concatenate((voltage, np.repeat(voltage[-1:], pad)))
+    bins = voltage.reshape(nbins, factor)
+
+    rows = np.arange(nbins)
+    imin = bins.argmin(axis=1)
+    imax = bins.argmax(axis=1)
+    vmin = bins[rows, imin]
+    vmax = bins[rows, imax]
+    min_first = imin <= imax
+
+    envelope = np.empty(2 * nbins, dtype=voltage.dtype)
+    envelope[0::2] = np.where(min_first, vmin, vmax)
+    envelope[1::2] = np.where(min_first, vmax, vmin)
+
+    return envelope
+
+
+# return the finest pyramid level allowing to display every sweep with at
+# most max_points points (the coarsest one if none of them does), None if
+# the full resolution data already fit
+def select_level(meta, max_points):
+    lengths = [length for (offset, length) in meta['traces'].values()]
+    if not lengths or max(lengths) <= max_points:
+        return None
+
+    levels = meta.get('pyramid', [])
+    for level in levels:
+        if max(length for (offset, length) in level['traces'].values()) \
+                <= max_points:
+            return level
+
+    return levels[-1] if levels else None
+
+
+# return a dictionary {stimulus label: memory mapped envelope} for a level
+def open_level(store_dir, name, level, meta):
+    mm = np.memmap(pyramid_path(store_dir, name), dtype=meta['dtype'], \
+            mode='r')
+    traces = {}
+    for label, (offset, length) in level['traces'].items():
+        traces[label] = mm[offset:offset + length]
+    return traces
+
+
+# read the [t_start, t_end] (ms) window of the given sweeps with at most
+# max_points points per sweep, by computing the offsets of the window
+# directly in the full resolution array or in the envelope pyramid
+def read_window(store_dir, name, meta, labels, t_start, t_end, max_points):
+    sampling_rate = float(meta['sampling_rate'])
+    labels = [i for i in labels if i in meta['traces']]
+    max_len = max([meta['traces'][i][1] for i in labels] or [0])
+
+    i_start = max(0, int(math.floor(t_start * sampling_rate / 1e3)))
+    i_end = min(max_len, int(math.ceil(t_end * sampling_rate / 1e3)))
+    span = max(0, i_end - i_start)
+
+    # pick the finest level fitting the requested number of points (an
+    # envelope needs at least a min/max pair)
+    level = None
+    if span > max_points and max_points >= 2:
+        for crr_level in meta.get('pyramid', []):
+            level = crr_level
+            if 2 * int(math.ceil(span / float(crr_level['factor']))) <= \
+                    max_points:
+                break
+
+    traces = {}
+    if level:
+        factor = level['factor']
+        b_start = i_start // factor
+        b_end = int(math.ceil(i_end / float(factor)))
+        # if even the coarsest level does not fit, merge groups of bins
+        merge = max(1, int(math.ceil((b_end - b_start) / \
+                float(max_points // 2))))
+        mm = np.memmap(pyramid_path(store_dir, name), dtype=meta['dtype'], \
+                mode='r')
+        for label in labels:
+            offset, length = level['traces'][label]
+            traces[label] = mm[offset + 2 * b_start:offset + \
+                    min(length, 2 * b_end)]
+            if merge > 1:
+                traces[label] = minmax_envelope(traces[label], 2 * merge)
+        coefficient = factor * merge / 2.
+        first_index = b_start * factor
+    else:
+        step = max(1, int(math.ceil(span / float(max(max_points, 1)))))
+        mm = np.memmap(data_path(store_dir, name), dtype=meta['dtype'], \
+                mode='r')
+        for label in labels:
+            offset, length = meta['traces'][label]
+            traces[label] = mm[offset + i_start:offset + \
+                    min(length, i_end):step]
+        coefficient = float(step)
+        first_index = i_start
+
+    return {
+        'traces': traces,
+        't_start': first_index / sampling_rate * 1e3,
+        'coefficient': coefficient,
+        'disp_sampling_rate': sampling_rate / coefficient,
+    }
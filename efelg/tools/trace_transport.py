@@ -0,0 +1,65 @@
+'''
+Binary encoding of the traces sent to the trace selection page.
+
+The payload is made of:
+ - the length (little-endian uint32) of the JSON header
+ - the JSON header, i.e. the cell metadata plus, under 'traces', the list
+   of [stimulus label, offset, length] of every sweep, offset and length
+   being expressed in number of values. The header is padded with spaces
+   to a multiple of 4 bytes
+ - the values of all the sweeps, one after the other, as little-endian
+   float32
+
+so that the browser can view every sweep as a Float32Array without parsing
+any number.
+'''
+
+import json
+import struct
+import numpy as np
+
+CONTENT_TYPE = 'application/octet-stream'
+DTYPE = '<f4'
+ALIGNMENT = 4
+
+
+# check whether the client asked for the binary encoding, either with the
+# 'format=bin' parameter or in the Accept header
+def wants_binary(request):
+    if request.GET.get('format') == 'bin':
+        return True
+    return CONTENT_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+
+# check whether the response can be gzip compressed
+def accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def encode(trace_info):
+    '''
+    Return the binary payload of trace_info, the dictionary built by
+    views.get_data with the {stimulus label: voltage array} traces
+    '''
+
+    header = dict((k, v) for k, v in trace_info.items() if k != 'traces')
+    header['traces'] = []
+    data = []
+    offset = 0
+    for label, voltage in trace_info['traces'].items():
+        voltage = np.asarray(voltage, dtype=DTYPE)
+        header['traces'].append([label, offset, len(voltage)])
+        data.append(voltage.tobytes())
+        offset += len(voltage)
+
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(len(header) + 4) % ALIGNMENT)
+
+    return struct.pack('<I', len(header)) + header + b''.join(data)
+
+
+# return the payload of trace_info preceded by its length (little-endian
+# uint32), i.e. a record of the stream sent by views.get_data_batch
+def encode_record(trace_info):
+    payload = encode(trace_info)
+    return struct.pack('<I', len(payload)) + payload
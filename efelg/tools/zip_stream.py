@@ -0,0 +1,134 @@
+'''
+Streaming zip writer for the result folders.
+
+The archive is produced on the fly, chunk by chunk, so that it can be sent
+in a StreamingHttpResponse without being written to disk first. Since the
+output is not seekable, the crc and the sizes of every member are written
+after its data, in a data descriptor, and repeated in the central directory.
+
+Members whose format is already compressed (e.g. the pdf figures) are
+stored, all the others are deflated. Zip64 is not supported, i.e. members
+and archives must be smaller than 4 GiB.
+'''
+
+import os
+import time
+import zlib
+import struct
+
+CONTENT_TYPE = 'application/zip'
+CHUNK_SIZE = 1 << 16
+
+# extensions of the members stored without compression
+STORED_EXTENSIONS = ('.pdf', '.zip', '.gz', '.png', '.jpg', '.jpeg')
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# general purpose flag: sizes and crc in the data descriptor, utf-8 names
+FLAGS = 0x08 | 0x800
+VERSION = 20
+
+
+def dos_time(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+            ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+# list the (absolute path, archive name) of the content of folder, with
+# names relative to the parent of folder
+def folder_members(folder):
+    parent_folder = os.path.dirname(os.path.abspath(folder))
+    members = []
+    for root, folders, files in os.walk(folder):
+        folders.sort()
+        for name in folders + sorted(files):
+            absolute_path = os.path.join(root, name)
+            relative_path = os.path.relpath(absolute_path, parent_folder)
+            members.append((absolute_path, relative_path.replace(os.sep, '/')))
+    return members
+
+
+def iter_zip(folder, chunk_size=CHUNK_SIZE):
+    '''
+    Yield the chunks of the zip archive of the content of folder
+    '''
+
+    central_directory = []
+    offset = 0
+    for absolute_path, name in folder_members(folder):
+        stat = os.stat(absolute_path)
+        is_dir = os.path.isdir(absolute_path)
+        if is_dir:
+            name += '/'
+            method = ZIP_STORED
+        elif name.lower().endswith(STORED_EXTENSIONS):
+            method = ZIP_STORED
+        else:
+            method = ZIP_DEFLATED
+        name = name.encode('utf-8')
+        mod_time, mod_date = dos_time(stat.st_mtime)
+
+        local_header = struct.pack('<IHHHHHIIIHH', 0x04034b50, VERSION, \
+                FLAGS, method, mod_time, mod_date, 0, 0, 0, len(name), 0) + \
+                name
+        yield local_header
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        if not is_dir:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, \
+                    zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+            with open(absolute_path, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    if compressor:
+                        chunk = compressor.compress(chunk)
+                    if chunk:
+                        compressed_size += len(chunk)
+                        yield chunk
+            if compressor:
+                chunk = compressor.flush()
+                compressed_size += len(chunk)
+                yield chunk
+        crc &= 0xffffffff
+
+        data_descriptor = struct.pack('<IIII', 0x08074b50, crc, \
+                compressed_size, size)
+        yield data_descriptor
+
+        external_attr = (stat.st_mode & 0xffff) << 16
+        if is_dir:
+            external_attr |= 0x10
+        central_directory.append(struct.pack('<IHHHHHHIIIHHHHHII', \
+                0x02014b50, (3 << 8) | VERSION, VERSION, FLAGS, method, \
+                mod_time, mod_date, crc, compressed_size, size, len(name), \
+                0, 0, 0, 0, external_attr, offset) + name)
+        offset += len(local_header) + compressed_size + len(data_descriptor)
+
+    central_directory_size = sum(len(i) for i in central_directory)
+    for record in central_directory:
+        yield record
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, \
+            len(central_directory), len(central_directory), \
+            central_directory_size, offset, 0)
+
+
+# write the zip archive of the content of folder to output_path
+def write_zip(folder, output_path):
+    tmp_output_path = output_path + '.%d.tmp' % os.getpid()
+    try:
+        with open(tmp_output_path, 'wb') as f:
+            for chunk in iter_zip(folder):
+                f.write(chunk)
+        os.rename(tmp_output_path, output_path)
+    finally:
+        if os.path.isfile(tmp_output_path):
+            os.remove(tmp_output_path)
@@ -15,9 +15,14 @@ urlpatterns = [
     url(r'^generate_json_data$', views.generate_json_data),
     url(r'^get_list$', views.get_list),
     url(r'^get_list_new$', views.get_list_new),
+    url(r'^search_traces$', views.search_traces),
+    url(r'^search_stimuli$', views.search_stimuli),
     url(r'^get_data/(?P<cellname>[0-9a-zA-Z_-]+)$', views.get_data),
+    url(r'^get_data_window/(?P<cellname>[0-9a-zA-Z_-]+)$', views.get_data_window),
+    url(r'^get_data_batch$', views.get_data_batch),
     url(r'^select_features/$', views.select_features),
     url(r'^extract-features$', views.extract_features),
+    url(r'^extraction_status$', views.extraction_status),
     url(r'^results/$', views.results),
     url(r'^status/$', views.status),
     url(r'^download_zip', views.download_zip),
@@ -26,6 +31,7 @@ urlpatterns = [
     url(r'^features-json-files-path', views.features_json_files_path),
     url(r'^protocols_json_path', views.protocols_json_path),
     url(r'^features_pdf_path', views.features_pdf_path),
+    url(r'^generate_plots$', views.generate_plots),
     url(r'^get_directory_structure', views.get_directory_structure),
     url(r'^upload_files', views.upload_files),
     url(r'^upload_zip_file_to_storage', views.upload_zip_file_to_storage),
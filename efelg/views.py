@@ -7,15 +7,18 @@ from mock import patch
 
 import os
 import urllib
+import subprocess
 from uuid import UUID
-import sys, datetime, shutil, zipfile, pprint
+import sys, datetime, shutil, zipfile, pprint, hashlib
 import numpy, efel, neo
 import math
+from concurrent import futures
 import matplotlib
 matplotlib.use('Agg')
 import requests
 import json
 import re
+import sqlite3
 import logging
 #import bluepyextract as bpext
 import bluepyefe as bpefe
@@ -27,8 +30,13 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.template.context import RequestContext
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, \
+        StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
+from django.utils.cache import patch_vary_headers, patch_cache_control
+from django.views.decorators.http import condition, require_POST
+from django.views.decorators.cache import cache_control
+from django.utils.text import compress_string, compress_sequence
 #from django.contrib.auth import logout
 
 # import hbp/bbp modules
@@ -44,6 +52,14 @@ import bbp_services.client as bsc
 # import local tools
 from tools import manage_json
 from tools import resources
+from tools import trace_store
+from tools import trace_index
+from tools import remote_cache
+from tools import extraction
+from tools import trace_transport
+from tools import feature_catalog
+from tools import feature_store
+from tools import zip_stream
 from tools import manage_collab_storage
 
 # import common tools library for the bspg project
@@ -60,6 +76,39 @@ accesslogger = logging.getLogger('efelg_access.log')
 accesslogger.addHandler(logging.FileHandler('/var/log/bspg/efelg_access.log'))
 accesslogger.setLevel(logging.DEBUG)
 
+# number of threads reading the cells requested to get_data_batch
+BATCH_WORKERS = 8
+
+# seconds during which browsers can reuse the traces sent by get_data
+# without revalidating them
+DATA_MAX_AGE = 300
+
+# seconds during which browsers can reuse the feature dictionary without
+# revalidating it
+FEATURES_DICT_MAX_AGE = 3600
+
+# trace list served by get_list_new
+LIST_NEW_PATH = os.path.join(settings.MEDIA_ROOT, 'efel_data', \
+        'eg_json_data', 'output.json')
+
+
+# return the etag of a file, based on its modification time and size
+def file_etag(filepath):
+    if not os.path.isfile(filepath):
+        return None
+    stat = os.stat(filepath)
+    return '%x-%x' % (int(stat.st_mtime * 1e6), stat.st_size)
+
+
+# return a function computing the etag of the responses depending only on
+# the session variable key (e.g. the *_path endpoints)
+def session_etag(key):
+    def etag_func(request, *args, **kwargs):
+        if not "ctx" in request.session or key not in request.session:
+            return None
+        return hashlib.md5(request.session[key].encode('utf-8')).hexdigest()
+    return etag_func
+
 ##### serve overview.html
 @login_required(login_url='/login/hbp/')
 def overview(request):
@@ -88,20 +137,22 @@ def overview(request):
         my_url = settings.HBP_MY_USER_URL
         hbp_collab_service_url = settings.HBP_COLLAB_SERVICE_URL + 'collab/context/'
 
-        # request user and collab details
-        res = requests.get(my_url, headers = headers)
-        collab_res = requests.get(hbp_collab_service_url + context, \
-                headers = headers)
+        # request user and collab details (cached for a few minutes)
+        user_prefix = remote_cache.user_prefix(request.user.social_auth.get())
+        res = remote_cache.get(my_url, headers, user_prefix + 'me')
+        collab_res = remote_cache.get(hbp_collab_service_url + context, \
+                headers, user_prefix + 'context:' + context)
         
         if res.status_code != 200 or collab_res.status_code != 200:
             manage_auth.Token.renewToken(request)
+            remote_cache.invalidate_user(request.user.social_auth.get())
             
             headers = {'Authorization': \
                 get_auth_header(request.user.social_auth.get())}
             
-            res = requests.get(my_url, headers = headers)
-            collab_res = requests.get(hbp_collab_service_url + context, \
-                headers = headers)
+            res = remote_cache.get(my_url, headers, user_prefix + 'me')
+            collab_res = remote_cache.get(hbp_collab_service_url + context, \
+                headers, user_prefix + 'context:' + context)
 
         if res.status_code != 200 or collab_res.status_code != 200:
             return render(request, 'efelg/hbp_redirect.html')
@@ -124,12 +175,16 @@ def overview(request):
     app_data_dir = os.path.join(settings.MEDIA_ROOT, 'efel_data', 'app_data')  
 
     json_dir = os.path.join(main_json_dir, 'traces')
+    store_dir = os.path.join(main_json_dir, 'trace_store')
+    index_path = os.path.join(main_json_dir, trace_index.INDEX_NAME)
     conf_dir = os.path.join(main_json_dir, 'conf_json')
     metadata_dir = os.path.join(main_json_dir, 'metadata')
 
     request.session['conf_dir'] = conf_dir
     request.session['data_dir'] = data_dir
     request.session['json_dir'] = json_dir
+    request.session['store_dir'] = store_dir
+    request.session['index_path'] = index_path
     request.session['app_data_dir'] = app_data_dir
 
     # create folders for global data and json files if not existing
@@ -142,6 +197,9 @@ def overview(request):
     if not os.path.exists(json_dir):
         os.makedirs(json_dir)
 
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
     # save parameters in request.session
     request.session["username"] = username
     request.session["userid"] = userid
@@ -220,10 +278,8 @@ def select_features(request):
         return render(request, 'efelg/hbp_redirect.html', {"status":"KO", "message":"Problem"})
 
     # read features groups
-    with open(os.path.join(settings.BASE_DIR, 'static', \
-            'efelg', 'efel_features_final.json')) as json_file:
-        features_dict = json.load(json_file) 
-    feature_names = efel.getFeatureNames()
+    features_dict = feature_catalog.catalog()
+    feature_names = feature_catalog.feature_names()
     selected_traces_rest = request.POST.get('data')
     selected_traces_rest_json = json.loads(selected_traces_rest)
     request.session['selected_traces_rest_json'] = selected_traces_rest_json
@@ -247,37 +303,24 @@ def generate_json_data(request):
 
     data_dir = request.session['data_dir']
     json_dir = request.session['json_dir']
-    all_files = os.listdir(data_dir)
-    files_authorization = {}
-
-    for name in all_files:
-        if name.endswith('.abf'):
-            fname = os.path.splitext(name)[0]
-            metadata_file = os.path.join(data_dir, fname + '_metadata.json')
-            if not os.path.isfile(metadata_file):
-                continue
-            else:
-                outfilename = \
-                        '____'.join(manage_json.get_cell_info(metadata_file)) \
-                        + '.json'
-                outfilepath = os.path.join(json_dir, outfilename)
-                crr_file_auth_collab = \
-                        manage_json.extract_authorized_collab(metadata_file)
-                if outfilepath not in files_authorization:
-                    files_authorization[outfilename] = crr_file_auth_collab
-
-                # if the .json file has not been created
-                if not os.path.isfile(outfilepath):
-                    path_dd_name = os.path.join(data_dir, name)
-                    data = manage_json.gen_data_struct(path_dd_name,\
-                            metadata_file)
-                    with open(outfilepath, 'w') as f:
-                        json.dump(data, f)
-    #
+    store_dir = request.session['store_dir']
+    index_path = request.session['index_path']
     app_data_dir = request.session['app_data_dir']
-    file_auth_fullpath = os.path.join(app_data_dir, "files_authorization.json")
-    with open(file_auth_fullpath, 'w') as fa:
-        json.dump(files_authorization, fa)
+
+    # the conversion runs in background, in a process pool (see the
+    # build_trace_repository management command)
+    try:
+        resources.start_management_command(['build_trace_repository', \
+                '--data-dir', data_dir, '--json-dir', json_dir, \
+                '--store-dir', store_dir, '--app-data-dir', app_data_dir, \
+                '--index-path', index_path], \
+                os.path.join(app_data_dir, 'trace_repository.log'))
+    except OSError as e:
+        logger.exception("trace repository build not started")
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "The trace repository build could not be " + \
+                "started: " + str(e)}), content_type="application/json", \
+                status=500)
 
     return HttpResponse("")
 
@@ -327,27 +370,39 @@ def get_list(request):
     crr_auth_data_list = resources.user_collab_list(my_collabs_url, \
             request.user.social_auth.get()) 
 
-    # retrieve the file containing the authorizations for each data file
-    conf_dir = request.session['conf_dir']
-    file_auth_fullpath = os.path.join(conf_dir, "files_authorization.json")
-    with open(file_auth_fullpath) as f:
-        files_auth = json.load(f)
+    # if available, use the metadata index built with the repository
+    index_path = request.session['index_path']
+    if os.path.isfile(index_path):
+        conn = trace_index.connect(index_path)
+        try:
+            allfiles = trace_index.authorized_files(conn, crr_auth_data_list)
+            output_json = trace_index.generate_json_output(conn, allfiles)
+        finally:
+            conn.close()
+        request.session["current_authorized_files"] = allfiles
+
+    else:
+        # retrieve the file containing the authorizations for each data file
+        conf_dir = request.session['conf_dir']
+        file_auth_fullpath = os.path.join(conf_dir, "files_authorization.json")
+        with open(file_auth_fullpath) as f:
+            files_auth = json.load(f)
     
-    #  
-    for i in os.listdir(json_dir):
-        crr_file_path = os.path.join(json_dir, i)
-        #if crr_file_path in files_auth:
+        #  
+        for i in os.listdir(json_dir):
+            crr_file_path = os.path.join(json_dir, i)
+            #if crr_file_path in files_auth:
 
-        if i in files_auth:
-            #crr_file_auth = files_auth[crr_file_path]
-            crr_file_auth = files_auth[i]
-            if any(j in crr_file_auth for j in crr_auth_data_list) or \
-                    crr_file_auth[0]=="all":
-                allfiles.append(i[:-5])
+            if i in files_auth:
+                #crr_file_auth = files_auth[crr_file_path]
+                crr_file_auth = files_auth[i]
+                if any(j in crr_file_auth for j in crr_auth_data_list) or \
+                        crr_file_auth[0]=="all":
+                    allfiles.append(i[:-5])
 
-    request.session["current_authorized_files"] = allfiles 
+        request.session["current_authorized_files"] = allfiles 
 
-    output_json = manage_json.generate_json_output(allfiles, json_dir)
+        output_json = manage_json.generate_json_output(allfiles, json_dir)
 
     user_dir = request.session['user_res_dir']
     with open(os.path.join(user_dir, 'output.json'), 'w') as f:
@@ -358,11 +413,137 @@ def get_list(request):
     return HttpResponse(json.dumps(output_json), content_type="application/json")
 
 
+#####
+@login_required(login_url='/login/hbp/')
+def search_traces(request):
+    '''
+    Return one page of the cells matching the facet filters ('species',
+    'area', ... parameters, repeatable) and the free text 'q' parameter,
+    with the counts of every facet value (see trace_index.search)
+    '''
+
+    # if not ctx exit the application 
+    if not "ctx" in request.session:
+        return render(request, 'efelg/hbp_redirect.html')
+
+    index_path = request.session['index_path']
+    if not os.path.isfile(index_path):
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Trace index not available"}), \
+                content_type="application/json", status=503)
+
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = min(trace_index.MAX_PAGE_SIZE, \
+                max(1, int(request.GET.get('limit', trace_index.PAGE_SIZE))))
+    except ValueError:
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Wrong page parameters"}), \
+                content_type="application/json", status=400)
+    filters = dict((k, request.GET.getlist(k)) for k in trace_index.FACETS)
+
+    my_collabs_url = settings.HBP_MY_COLLABS_URL
+    crr_auth_data_list = resources.user_collab_list(my_collabs_url, \
+            request.user.social_auth.get()) 
+
+    conn = trace_index.connect(index_path)
+    try:
+        result = trace_index.search(conn, crr_auth_data_list, filters, \
+                request.GET.get('q', '').strip(), offset, limit)
+    finally:
+        conn.close()
+
+    # the traces of the cells found are read through get_data, which only
+    # serves the authorized files
+    authorized_files = request.session.get("current_authorized_files", [])
+    new_files = [i['file'] for i in result['cells'] \
+            if i['file'] not in authorized_files]
+    if new_files:
+        request.session["current_authorized_files"] = authorized_files + \
+                sorted(set(new_files))
+        request.session.modified = True
+
+    return HttpResponse(json.dumps(result), content_type="application/json")
+
+
+#####
+@login_required(login_url='/login/hbp/')
+def search_stimuli(request):
+    '''
+    Return the traces whose stimulus amplitude is within 'tolerance' of one
+    of the 'amp' parameters (repeatable), in the 'amp_unit' unit, optionally
+    restricted to the 'cell' parameters (repeatable). The traces are also
+    grouped in the format of the selection sent to select_features
+    '''
+
+    # if not ctx exit the application 
+    if not "ctx" in request.session:
+        return render(request, 'efelg/hbp_redirect.html')
+
+    index_path = request.session['index_path']
+    if not os.path.isfile(index_path):
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Trace index not available"}), \
+                content_type="application/json", status=503)
+
+    try:
+        amp_unit = request.GET.get('amp_unit', 'nA')
+        targets = [float(i) for i in request.GET.getlist('amp')]
+        # the default tolerance of the extraction is in nA
+        tolerance = [float(i) for i in request.GET.getlist('tolerance')] or \
+                extraction.default_options(targets)['tolerance'] / \
+                trace_index.amp_factor(amp_unit)
+        if isinstance(tolerance, list) and len(tolerance) == 1:
+            tolerance = tolerance[0]
+        if isinstance(tolerance, list) and len(tolerance) != len(targets):
+            raise ValueError
+    except ValueError:
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Wrong amplitude parameters"}), \
+                content_type="application/json", status=400)
+    files = request.GET.getlist('cell') or None
+
+    my_collabs_url = settings.HBP_MY_COLLABS_URL
+    crr_auth_data_list = resources.user_collab_list(my_collabs_url, \
+            request.user.social_auth.get()) 
+
+    conn = trace_index.connect(index_path)
+    try:
+        stimuli = trace_index.stimuli_in_range(conn, crr_auth_data_list, \
+                targets, tolerance, amp_unit, files)
+    except sqlite3.OperationalError:
+        # index built before the stimuli table (or its amplitude in nA) was
+        # introduced
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Trace index not available"}), \
+                content_type="application/json", status=503)
+    finally:
+        conn.close()
+
+    return HttpResponse(json.dumps({"traces": stimuli, \
+            "selection": trace_index.selection(stimuli)}), \
+            content_type="application/json")
+
+
+# validators of get_list_new, based on the modification time and the size
+# of the file it serves
+def list_new_etag(request):
+    return file_etag(LIST_NEW_PATH)
+
+
+def list_new_last_modified(request):
+    if not os.path.isfile(LIST_NEW_PATH):
+        return None
+    return datetime.datetime.utcfromtimestamp( \
+            os.path.getmtime(LIST_NEW_PATH))
+
+
 ##### 
 '''
 Retrieve the list of .json files to be displayed for trace selection
 '''
 # @login_required(login_url='/login/hbp/')
+@condition(etag_func=list_new_etag, last_modified_func=list_new_last_modified)
 def get_list_new(request):
     
     # final list of authorized files
@@ -398,11 +579,41 @@ def get_list_new(request):
     # request.session["current_authorized_files"] = allfiles
 
     # return HttpResponse(json.dumps(allfiles), content_type="application/json")
-    json_file = open(os.path.join(settings.MEDIA_ROOT, 'efel_data', 'eg_json_data', 'output.json'))
+    json_file = open(LIST_NEW_PATH)
     return HttpResponse(json_file, content_type="application/json")
 
+# etag of the get_data responses: the md5 of the cell traces (or the
+# modification time and size of its .json file) and the display options
+def get_data_etag(request, cellname=""):
+    if not "ctx" in request.session:
+        return None
+
+    json_dir = request.session['json_dir']
+    store_dir = request.session['store_dir']
+    u_up_dir = request.session['u_up_dir']
+    if cellname not in request.session["current_authorized_files"] and not \
+            os.path.isfile(os.path.join(u_up_dir, cellname)):
+        return None
+
+    crr_store_dir = trace_store.find_cell(cellname, [store_dir, u_up_dir])
+    if crr_store_dir:
+        version = trace_store.read_meta(crr_store_dir, cellname)['md5']
+    else:
+        version = file_etag(os.path.join(json_dir, cellname) + '.json') or \
+                file_etag(os.path.join(u_up_dir, cellname) + '.json')
+    if not version:
+        return None
+
+    return hashlib.md5(json.dumps([cellname, version, \
+            request.GET.get('points', None), \
+            trace_transport.wants_binary(request), \
+            trace_transport.accepts_gzip(request)]).encode('utf-8')) \
+            .hexdigest()
+
+
 #####
 @login_required(login_url='/login/hbp/')
+@condition(etag_func=get_data_etag)
 def get_data(request, cellname=""):
 
     # if not ctx exit the application 
@@ -410,26 +621,87 @@ def get_data(request, cellname=""):
         return render(request, 'efelg/hbp_redirect.html')
 
 
-    disp_sampling_rate = 5000
     json_dir = request.session['json_dir']
+    store_dir = request.session['store_dir']
     u_up_dir = request.session['u_up_dir']
     current_authorized_files = request.session["current_authorized_files"]
 
     if cellname not in current_authorized_files and not \
             os.path.isfile(os.path.join(u_up_dir, cellname)):
         return HttpResponse("")
+
+    try:
+        max_points = points_param(request)
+    except ValueError:
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Wrong points parameter"}), \
+                content_type="application/json", status=400)
+
+    trace_info = read_trace_info(cellname, json_dir, store_dir, u_up_dir, \
+            max_points)
+
+    # send float32 arrays if requested (see trace_transport)
+    if trace_transport.wants_binary(request):
+        content = trace_transport.encode(trace_info)
+        gzip = trace_transport.accepts_gzip(request)
+        if gzip:
+            content = compress_string(content)
+        response = HttpResponse(content, \
+                content_type=trace_transport.CONTENT_TYPE)
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+        # only the traces can be reused without revalidation
+        patch_cache_control(response, private=True, max_age=DATA_MAX_AGE)
+        return response
+
+    for key in trace_info['traces']:
+        trace_info['traces'][key] = trace_info['traces'][key].tolist()
     
-    if os.path.isfile(os.path.join(json_dir, cellname) + '.json'):
-        cellname_path = os.path.join(json_dir, cellname) + '.json'
+    response = HttpResponse(json.dumps(json.dumps(trace_info)), \
+            content_type="application/json")
+    # the format depends on the Accept header (see above)
+    patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+    patch_cache_control(response, private=True, max_age=DATA_MAX_AGE)
+    return response
+
+
+# return the number of points per trace requested with the 'points'
+# parameter, None if not given. Raise ValueError if it is not a positive
+# integer
+def points_param(request):
+    max_points = request.GET.get('points', None)
+    if max_points is None:
+        return None
+    max_points = int(max_points)
+    if max_points < 1:
+        raise ValueError("points must be positive")
+    return max_points
+
+
+# read the traces of a cell to be displayed, i.e. decimated to the display
+# sampling rate or to max_points points per trace, with its metadata. The
+# min/max envelopes of the store are sent as they are, coefficient being
+# the number of samples each of their points stands for
+def read_trace_info(cellname, json_dir, store_dir, u_up_dir, max_points=None):
+    disp_sampling_rate = 5000
+
+    # read from the binary store if available, from the .json file otherwise
+    crr_store_dir = trace_store.find_cell(cellname, [store_dir, u_up_dir])
+    if crr_store_dir:
+        content = trace_store.read_meta(crr_store_dir, cellname)
+        traces = trace_store.open_traces(crr_store_dir, cellname, content)
+    else:
+        if os.path.isfile(os.path.join(json_dir, cellname) + '.json'):
+            cellname_path = os.path.join(json_dir, cellname) + '.json'
         
-    elif os.path.isfile(os.path.join(u_up_dir, cellname) \
-            + '.json'):
-        cellname_path = os.path.join(u_up_dir, cellname) \
-                + '.json'
+        elif os.path.isfile(os.path.join(u_up_dir, cellname) \
+                + '.json'):
+            cellname_path = os.path.join(u_up_dir, cellname) \
+                    + '.json'
 
-    with open(cellname_path) as f:
-        content_json = f.read()
-    content = json.loads(content_json)
+        content = manage_json.read_json(cellname_path)
+        traces = dict((t.label, t.voltage) for t in content['traces'])
 
     # extract data to be sent to frontend
     crr_sampling_rate = content['sampling_rate']
@@ -437,11 +709,31 @@ def get_data(request, cellname=""):
     if coefficient < 1:
         coefficient = 1
         disp_sampling_rate = crr_sampling_rate
+    step = coefficient
+
+    # if available, use the min/max envelopes matching the requested number
+    # of points per trace (by default, the one of the display sampling rate)
+    if crr_store_dir:
+        max_len = max([i[1] for i in content['traces'].values()] or [0])
+        if not max_points:
+            max_points = int(math.ceil(max_len / float(coefficient)))
+        level = trace_store.select_level(content, max_points)
+        if level:
+            # the envelope is already decimated, do not stride it
+            traces = trace_store.open_level(crr_store_dir, cellname, \
+                    level, content)
+            coefficient = level['factor'] // 2
+            disp_sampling_rate = crr_sampling_rate / coefficient
+            step = 1
+        elif max_points >= max_len:
+            coefficient = 1
+            disp_sampling_rate = crr_sampling_rate
+            step = 1
     
     trace_info = {}
     trace_info['traces'] = {}
-    for key in content['traces'].keys():
-        trace_info['traces'][key] = content['traces'][key][::coefficient]
+    for key in traces.keys():
+        trace_info['traces'][key] = numpy.asarray(traces[key][::step])
     trace_info['md5'] = content['md5']
     trace_info['species'] = content['species']
     trace_info['sampling_rate'] = content['sampling_rate']
@@ -457,8 +749,129 @@ def get_data(request, cellname=""):
     trace_info['volt_unit'] = content['volt_unit']
     trace_info['disp_sampling_rate'] = disp_sampling_rate
 
-    
-    return HttpResponse(json.dumps(json.dumps(trace_info)), content_type="application/json")
+    return trace_info
+
+
+#####
+@login_required(login_url='/login/hbp/')
+@require_POST
+def get_data_batch(request):
+    '''
+    Stream the traces of all the cells posted as 'cell' fields, read
+    concurrently. Every cell is sent as soon as it is read, either as a
+    binary record (see trace_transport.encode_record) or as a line of json
+    '''
+
+    # if not ctx exit the application 
+    if not "ctx" in request.session:
+        return render(request, 'efelg/hbp_redirect.html')
+
+    json_dir = request.session['json_dir']
+    store_dir = request.session['store_dir']
+    u_up_dir = request.session['u_up_dir']
+    current_authorized_files = request.session["current_authorized_files"]
+
+    cellnames = [i for i in request.POST.getlist('cell') if i in \
+            current_authorized_files or os.path.isfile(os.path.join(u_up_dir, \
+            i))]
+    try:
+        max_points = points_param(request)
+    except ValueError:
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Wrong points parameter"}), \
+                content_type="application/json", status=400)
+    binary = trace_transport.wants_binary(request)
+
+    def stream():
+        executor = futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+        try:
+            fs = dict((executor.submit(read_trace_info, i, json_dir, \
+                    store_dir, u_up_dir, max_points), i) for i in cellnames)
+            for f in futures.as_completed(fs):
+                try:
+                    trace_info = f.result()
+                except Exception as e:
+                    logger.exception("traces of %s not available", fs[f])
+                    trace_info = {'traces': {}, 'error': str(e)}
+                trace_info['cellname'] = fs[f]
+                if binary:
+                    yield trace_transport.encode_record(trace_info)
+                else:
+                    for key in trace_info['traces']:
+                        trace_info['traces'][key] = \
+                                trace_info['traces'][key].tolist()
+                    yield json.dumps(trace_info) + '\n'
+        finally:
+            executor.shutdown(wait=False)
+
+    gzip = trace_transport.accepts_gzip(request)
+    response = StreamingHttpResponse(compress_sequence(stream()) if gzip \
+            else stream(), content_type=trace_transport.CONTENT_TYPE if \
+            binary else 'application/x-ndjson')
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+
+    return response
+
+
+#####
+@login_required(login_url='/login/hbp/')
+def get_data_window(request, cellname=""):
+    '''
+    Return the [t_start, t_end] window (in ms) of the selected stimuli of a 
+    cell, with at most 'points' points per trace
+    '''
+
+    # if not ctx exit the application 
+    if not "ctx" in request.session:
+        return render(request, 'efelg/hbp_redirect.html')
+
+    store_dir = request.session['store_dir']
+    u_up_dir = request.session['u_up_dir']
+    current_authorized_files = request.session["current_authorized_files"]
+
+    if cellname not in current_authorized_files and not \
+            os.path.isfile(os.path.join(u_up_dir, cellname)):
+        return HttpResponse("")
+
+    crr_store_dir = trace_store.find_cell(cellname, [store_dir, u_up_dir])
+    if not crr_store_dir:
+        return HttpResponse("")
+
+    try:
+        stim = request.GET.getlist('stim')
+        t_start = float(request.GET['t_start'])
+        t_end = float(request.GET['t_end'])
+        max_points = int(request.GET.get('points', 2000))
+        # inf and nan are accepted by float but cannot be turned into
+        # sample indexes
+        if math.isinf(t_start) or math.isnan(t_start) or \
+                math.isinf(t_end) or math.isnan(t_end) or \
+                t_end <= t_start or max_points < 1:
+            raise ValueError
+    except (KeyError, ValueError):
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "Wrong window parameters"}), \
+                content_type="application/json", status=400)
+
+    content = trace_store.read_meta(crr_store_dir, cellname)
+    if not stim:
+        stim = content['traces'].keys()
+    window = trace_store.read_window(crr_store_dir, cellname, content, \
+            stim, t_start, t_end, max_points)
+
+    window_info = {}
+    window_info['traces'] = {}
+    for key in window['traces'].keys():
+        window_info['traces'][key] = window['traces'][key].tolist()
+    window_info['md5'] = content['md5']
+    window_info['t_start'] = window['t_start']
+    window_info['coefficient'] = window['coefficient']
+    window_info['disp_sampling_rate'] = window['disp_sampling_rate']
+
+    return HttpResponse(json.dumps(window_info), \
+            content_type="application/json")
 
 
 #####
@@ -469,10 +882,21 @@ def extract_features(request):
     if not "ctx" in request.session:
         return render(request, 'efelg/hbp_redirect.html')
 
+    # processes computing the eFEL features, at most the ones of a job
+    try:
+        efel_workers = int(request.GET.get('efel_workers', \
+                extraction.EFEL_WORKERS))
+    except ValueError:
+        return HttpResponse(json.dumps({"status": "KO", \
+                "message": "efel_workers must be an integer"}), \
+                content_type="application/json", status=400)
+    efel_workers = max(1, min(efel_workers, extraction.EFEL_WORKERS))
+
     data_dir = request.session['data_dir']
     json_dir = request.session['json_dir']
+    store_dir = request.session['store_dir']
     selected_traces_rest_json = request.session['selected_traces_rest_json'] 
-    allfeaturesnames = efel.getFeatureNames()
+    allfeaturesnames = feature_catalog.feature_names()
     
     crr_user_folder = request.session['time_info'] 
     full_crr_result_folder = request.session['u_crr_res_r_dir']
@@ -483,6 +907,7 @@ def extract_features(request):
     request.session['selected_features'] = check_features 
     cell_dict = {}
     selected_traces_rest = []
+    selected_md5 = {}
 
     for k in selected_traces_rest_json:
         #crr_vcorr = selected_traces_rest_json[k]['vcorr']
@@ -502,11 +927,18 @@ def extract_features(request):
         else:
             continue
 
-        with open(crr_json_file) as f:
-            crr_file_dict_read = f.read()
-
-        crr_file_dict = json.loads(crr_file_dict_read)
+        # only the metadata are needed here, read them from the binary
+        # store sidecar when available
+        crr_store_dir = trace_store.find_cell(k, [store_dir, \
+                full_crr_uploaded_folder])
+        if crr_store_dir:
+            crr_file_dict = trace_store.read_meta(crr_store_dir, k)
+        else:
+            with open(crr_json_file) as f:
+                crr_file_dict_read = f.read()
+            crr_file_dict = json.loads(crr_file_dict_read)
         crr_file_all_stim = crr_file_dict['traces'].keys()
+        selected_md5[k] = crr_file_dict['md5']
         crr_file_amp_unit = crr_file_dict['amp_unit']
         crr_file_sel_stim = selected_traces_rest_json[k]['stim']
 
@@ -514,7 +946,9 @@ def extract_features(request):
         crr_cell_data_folder = full_crr_data_folder
         if not os.path.exists(crr_cell_data_folder):
             os.makedirs(crr_cell_data_folder)
-        shutil.copy2(crr_json_file, crr_cell_data_folder)
+        # bluepyefe only reads the traces, link them instead of copying
+        extraction.link_file(crr_json_file, os.path.join( \
+                crr_cell_data_folder, crr_file_rest_name), symlink=True)
 
         #
         if crr_key in cell_dict:
@@ -557,85 +991,68 @@ def extract_features(request):
     config['format'] = 'ibf_json'
     config['comment'] = []
     config['cells'] = final_cell_dict
-    config['options'] = {
-            'featconffile': './pt_conf.json',
-            'featzerotonan': False,
-            'relative': False, 
-            'tolerance': 0.02,
-            'target': target, 
-            'target_unit': 'nA',
-            'delay': 500, 
-            'nanmean': True, 
-            'logging':True, 
-            'nangrace': 0, 
-            'spike_threshold': 1, 
-            'amp_min': -1e22, 
-            'zero_std': False,
-            'trace_check': False,
-            'strict_stiminterval': {
-                'base': True
-                },
-            'print_table': {
-                    'flag': True,
-                    'num_events': 5,
-                    }
-            }
-    try:
-        extractor = bpefe.Extractor(full_crr_result_folder, config, use_git=False)
-        extractor.create_dataset()
-        extractor.plt_traces()
-        extractor.extract_features()
-        extractor.mean_features()
-        extractor.plt_features()
-        extractor.feature_config_cells(version="legacy")
-        extractor.feature_config_all(version="legacy")
-    except:
-        return render(request, 'efelg/hbp_redirect.html', {"status":"KO", \
-                "message": "An error occured while extracting the features. \
-                Either you selected too many data or the traces were corrupted."})
-
-
+    config['options'] = extraction.default_options(target, efel_workers)
     conf_dir = request.session['conf_dir']
     conf_cit = os.path.join(conf_dir, 'citation_list.json')
     final_cit_file = os.path.join(full_crr_result_folder, 'HOWTOCITE.txt')
-    resources.print_citations(selected_traces_rest_json, conf_cit, final_cit_file)   
 
     crr_result_folder = request.session['time_info']
     output_path = os.path.join(full_crr_user_folder, crr_user_folder + \
             '_results.zip')
     request.session['result_file_zip'] = output_path
     request.session['result_file_zip_name'] = crr_user_folder + '_results.zip'
-    parent_folder = os.path.dirname(full_crr_result_folder)
-    contents = os.walk(full_crr_result_folder)
-    try:
-        zip_file = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED)
-        for root, folders, files in contents:
-            for folder_name in folders:
-                absolute_path = os.path.join(root, folder_name)
-                relative_path = absolute_path.replace(parent_folder + \
-                        os.sep, '')
-                zip_file.write(absolute_path, relative_path)
-            for file_name in files:
-                absolute_path = os.path.join(root, file_name)
-                relative_path = absolute_path.replace(parent_folder + \
-                        os.sep, '')
-                zip_file.write(absolute_path, relative_path)
-    except IOError as message:
-        print(message)
-        sys.exit(1)
-    except OSError as message:
-        print(message)
-        sys.exit(1)
-    except zip_file.BadZipfile as message:
-        print(message)
-        sys.exit(1)
-    finally:
-        zip_file.close()
 
+    # run the extraction in background, its progress is polled through
+    # the extraction_status endpoint
+    if not os.path.exists(full_crr_user_folder):
+        os.makedirs(full_crr_user_folder)
+    job = {
+        'config': config,
+        'result_dir': full_crr_result_folder,
+        'selected_traces': list(selected_traces_rest_json),
+        'citation_conf': conf_cit,
+        'citation_file': final_cit_file,
+        'cell_workers': extraction.CELL_WORKERS,
+        'feature_store': feature_store.STORE_PATH,
+        'feature_memo': feature_store.MEMO_PATH,
+        'plots': request.GET.get('plots', '1') != '0',
+        'cache_key': extraction.cache_key(config, selected_md5, \
+                dict((k, selected_traces_rest_json[k]) for k in selected_md5)),
+    }
+    # the results of the same extraction are served from the cache,
+    # otherwise the job is run in background
+    if extraction.load_cached(full_crr_user_folder, job):
+        job_status = extraction.OK
+    elif extraction.submit(full_crr_user_folder, job):
+        job_status = extraction.QUEUED
+    else:
+        job_status = extraction.KO
 
     accesslogger.info(resources.string_for_log('extract_features', \
             request, page_spec_string = '___'.join(check_features)))
-    return HttpResponse(json.dumps({"status": "OK"})) 
+    return HttpResponse(json.dumps({"status": job_status, \
+            "job_id": crr_user_folder}), content_type="application/json")
+
+
+#####
+@login_required(login_url='/login/hbp/')
+def extraction_status(request):
+    '''
+    Return the status of the current feature extraction job
+    '''
+
+    # if not ctx exit the application 
+    if not "ctx" in request.session:
+        return render(request, 'efelg/hbp_redirect.html')
+
+    full_crr_user_folder = request.session['user_crr_res_dir']
+    job_status = extraction.check_status(full_crr_user_folder)
+    if job_status is None:
+        job_status = {"status": extraction.KO, "message": "No extraction job"}
+    job_status['job_id'] = request.session['time_info']
+
+    return HttpResponse(json.dumps(job_status), \
+            content_type="application/json")
 
 
 #####
@@ -662,17 +1079,25 @@ def download_zip(request):
         return render(request, 'efelg/hbp_redirect.html')
 
     accesslogger.info(resources.string_for_log('download_zip', request))
-    result_file_zip = request.session['result_file_zip']
     result_file_zip_name = request.session['result_file_zip_name']
-    zip_file = open(result_file_zip, 'rb')
-    response = HttpResponse(zip_file, content_type='application/force-download')
+    # the archive is built on the fly from the result folder
+    response = StreamingHttpResponse(zip_stream.iter_zip( \
+            request.session['u_crr_res_r_dir']), \
+            content_type='application/force-download')
     response['Content-Disposition'] = 'attachment; filename="%s"' % \
             result_file_zip_name
     return response
 
 
+def features_dict_etag(request):
+    if not "ctx" in request.session:
+        return None
+    return feature_catalog.etag()
+
+
 #####
 @login_required(login_url='/login/hbp/')
+@condition(etag_func=features_dict_etag)
 def features_dict(request):
 
     # if not ctx exit the application 
@@ -680,10 +1105,10 @@ def features_dict(request):
         return render(request, 'efelg/hbp_redirect.html')
 
     '''Render the feature dictionary containing all feature names, grouped by feature type'''
-    with open(os.path.join(settings.BASE_DIR, 'static', 'efelg',\
-            'efel_features_final.json')) as json_file:
-        features_dict = json.load(json_file) 
-    return HttpResponse(json.dumps(features_dict))
+    response = HttpResponse(feature_catalog.catalog_json())
+    patch_cache_control(response, private=True, \
+            max_age=FEATURES_DICT_MAX_AGE)
+    return response
 
 
 #####
@@ -703,6 +1128,8 @@ def features_json(request):
 
 #####
 @login_required(login_url='/login/hbp/')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=session_etag('media_abs_crr_user_res'))
 def features_json_path(request):
 
     # if not ctx exit the application 
@@ -716,6 +1143,8 @@ def features_json_path(request):
 
 #####
 @login_required(login_url='/login/hbp/')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=session_etag('media_abs_crr_user_res'))
 def features_json_files_path(request):
 
     # if not ctx exit the application 
@@ -727,6 +1156,8 @@ def features_json_files_path(request):
 
 #####
 @login_required(login_url='/login/hbp/')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=session_etag('media_rel_crr_user_res'))
 def protocols_json_path(request):
 
     # if not ctx exit the application 
@@ -739,18 +1170,62 @@ def protocols_json_path(request):
             full_feature_json_file)}))
 
 
+# the etag of features_pdf_path changes once the figures are generated
+def features_pdf_etag(request):
+    if not "ctx" in request.session:
+        return None
+    pdf_etag = file_etag(os.path.join(request.session['u_crr_res_r_dir'], \
+            'features_step.pdf'))
+    return hashlib.md5(json.dumps([request.session['media_rel_crr_user_res'],\
+            pdf_etag]).encode('utf-8')).hexdigest()
+
+
 #####
 @login_required(login_url='/login/hbp/')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=features_pdf_etag)
 def features_pdf_path(request):
 
     # if not ctx exit the application 
     if not "ctx" in request.session:
         return render(request, 'efelg/hbp_redirect.html')
 
+    # the figures of jobs run without plots are only available once
+    # requested through generate_plots
+    ready = os.path.isfile(os.path.join(request.session['u_crr_res_r_dir'], \
+            'features_step.pdf'))
+
     rel_url = request.session['media_rel_crr_user_res']
     full_feature_json_file = os.path.join(rel_url, 'features_step.pdf')
     return HttpResponse(json.dumps({'path' : os.path.join(os.sep, \
-            full_feature_json_file)}))
+            full_feature_json_file), 'ready': ready}))
+
+
+#####
+@login_required(login_url='/login/hbp/')
+@require_POST
+def generate_plots(request):
+    '''
+    Start the generation of the figures of the current extraction job, if
+    run without plots. Return whether they are ready and the job status,
+    whose progress is then polled through the extraction_status endpoint
+    '''
+
+    # if not ctx exit the application 
+    if not "ctx" in request.session:
+        return render(request, 'efelg/hbp_redirect.html')
+
+    ready = os.path.isfile(os.path.join(request.session['u_crr_res_r_dir'], \
+            'features_step.pdf'))
+    job_status = {}
+    if not ready:
+        job_status = extraction.submit_plots( \
+                request.session['user_crr_res_dir']) or {}
+
+    return HttpResponse(json.dumps({'ready': ready, \
+            'status': job_status.get('status', extraction.OK if ready \
+            else extraction.KO), 'message': job_status.get('message', '')}), \
+            content_type="application/json")
 
 
 #####
@@ -775,6 +1250,7 @@ def upload_files(request):
     names_full_path = []
 
     data_name_dict = {"all_json_names" : []}
+    all_authorized_files = request.session["current_authorized_files"]
     
     #for every files to be uploaded, save them on local folders:
     for k in user_files:
@@ -788,37 +1264,51 @@ def upload_files(request):
         # if file exists delete and recreate it
         if os.path.isfile(crr_local_filename):
             os.remove(crr_local_filename)
-        final_file = open(crr_local_filename, 'w')
+        final_file = open(crr_local_filename, 'wb')
         
-        # save chunks or entire file based on dimensions
-        if k.multiple_chunks():
-            for chunk in k.chunks():
-                final_file.write(chunk)
-            final_file.close()
-        else:
-            final_file.write(k.read())
-            final_file.close()
-
-        # 
-        if resources.check_file_validity(crr_local_filename):
+        # save the file chunk by chunk, computing its md5 on the fly
+        crr_md5 = hashlib.md5()
+        for chunk in k.chunks():
+            crr_md5.update(chunk)
+            final_file.write(chunk)
+        final_file.close()
+
+        # validate the file from its header, before decoding any signal
+        try:
+            crr_reader = manage_json.open_abf(crr_local_filename)
+        except Exception:
+            logger.exception("%s is not a valid abf file", crr_file_name)
+            crr_reader = None
+        crr_abf = None
+        if crr_reader and resources.check_file_validity(crr_local_filename, \
+                reader = crr_reader):
+            # decode the file once, for the conversion
+            try:
+                crr_abf = manage_json.read_abf(crr_local_filename, crr_reader)
+            except Exception:
+                logger.exception("signals of %s not readable", \
+                        crr_file_name)
+        crr_reader = None
+        if crr_abf:
             name_abf_list.append(crr_file_name) 
             names_full_path.append(crr_local_filename)
         else:
             os.remove(crr_local_filename)
-            
+            continue
 
-    #  
-    all_authorized_files = request.session["current_authorized_files"]
-    for name in names_full_path:
+        name = crr_local_filename
         outfilename = '____'.join(manage_json.get_cell_info(name, \
                 upload_flag = True)) + '.json'
         outfilepath = os.path.join(u_up_dir, outfilename)
 
-        data = manage_json.gen_data_struct(name, name,  upload_flag = True)
+        data = manage_json.gen_data_struct(name, name,  upload_flag = True, \
+                abf = crr_abf, md5sum = crr_md5.hexdigest())
+        crr_abf = None
         if os.path.isfile(outfilepath):
             os.remove(outfilepath)        
         with open(outfilepath, 'w') as f:
-            json.dump(data, f)
+            manage_json.write_json(data, f)
+        trace_store.write_cell(u_up_dir, outfilename[:-5], data)
         if outfilename[:-5] not in data_name_dict['all_json_names']:
             data_name_dict['all_json_names'].append(outfilename[:-5])
             all_authorized_files.append(outfilename[:-5])
@@ -902,7 +1392,12 @@ def upload_zip_file_to_storage(request):
 
     # bypassing uploading data to collab storage
     if not doc_client.exists(zip_collab_storage_path):
-        doc_client.upload_file(output_path, zip_collab_storage_path) 
+        # the zip file is written to disk only for the upload
+        zip_stream.write_zip(request.session['u_crr_res_r_dir'], output_path)
+        try:
+            doc_client.upload_file(output_path, zip_collab_storage_path) 
+        finally:
+            os.remove(output_path)
 
     # render to html page
     return HttpResponse("") 